@@ -1,9 +1,14 @@
 import os
 import yaml
+import json
+import time
+import httpx
 import logging
 import requests
+import threading
 import sentry_sdk
-from openai import OpenAI
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from openai import OpenAI, NotFoundError, BadRequestError
 from typing_extensions import override
 from openai import AssistantEventHandler
 from openai.types.beta import AssistantStreamEvent
@@ -12,12 +17,34 @@ from openai.types.beta.threads.runs import RunStep, RunStepDelta
 from langchain_community.callbacks.openai_info import get_openai_token_cost_for_model
 
 from tools import *
+from uploads import upload_manager
 
 BASE_MODEL = os.getenv("BASE_MODEL", "gpt-3.5-turbo-0125")
 HEAVY_MODEL = os.getenv("HEAVY_MODEL", "gpt-4-turbo-preview")
 
+# OpenAI APIへの接続プールの設定
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "20"))
+OPENAI_MAX_CONNECTIONS = int(os.getenv("OPENAI_MAX_CONNECTIONS", "20"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "10")
+)
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+# 使われていないクライアントを破棄するまでの秒数
+OPENAI_CLIENT_IDLE_TTL = int(os.getenv("OPENAI_CLIENT_IDLE_TTL", "900"))
+# アシスタントの状態のキャッシュを信頼する秒数
+ASSISTANT_STATE_TTL = int(os.getenv("ASSISTANT_STATE_TTL", "300"))
+# Runの設定方法
+# override: モデルや指示、ツールをRun単位で指定し、アシスタントは変更しない
+# update: Runの前にアシスタントを更新する
+ASSISTANT_RUN_MODE = os.getenv("ASSISTANT_RUN_MODE", "override")
+
 
 # https://platform.openai.com/docs/assistants/tools/supported-files
+# 同時に実行するツール呼び出しの数
+TOOL_CALL_WORKERS = int(os.getenv("TOOL_CALL_WORKERS", "4"))
+# ツール呼び出し1件あたりのタイムアウト
+TOOL_CALL_TIMEOUT = int(os.getenv("TOOL_CALL_TIMEOUT", "120"))
+
 RETRIEVAL_EXTS = (
     ".c",  # text/x-c
     ".cpp",  # text/x-c++
@@ -46,33 +73,173 @@ CODE_INTERPRETER_EXTS = (
 ) + RETRIEVAL_EXTS
 
 
+# OpenAI APIへのリクエストの接続の再利用率とレイテンシを記録するクラスです。
+class ConnectionStats:
+    def __init__(self) -> None:
+        self.requests = 0
+        self.new_connections = 0
+        self.lock = threading.Lock()
+
+    # リクエストの送信前に呼び出されます。
+    def on_request(self, request):
+        state = {"start_time": time.perf_counter(), "new_connection": False}
+
+        # httpcoreのトレースで新しいTCP接続が確立されたかを判定する
+        def trace(event_name, info):
+            if event_name == "connection.connect_tcp.started":
+                state["new_connection"] = True
+
+        request.extensions["trace"] = trace
+        request.extensions["timing"] = state
+
+    # レスポンスのヘッダーを受信したときに呼び出されます。
+    def on_response(self, response):
+        state = response.request.extensions.get("timing")
+        if state is None:
+            return
+        latency = time.perf_counter() - state["start_time"]
+        with self.lock:
+            self.requests += 1
+            if state["new_connection"]:
+                self.new_connections += 1
+            reuse_ratio = 1 - self.new_connections / self.requests
+        logging.info(
+            f"openai {response.request.method} {response.request.url.path} "
+            f"{response.status_code} {latency:.3f}s "
+            f"reused={not state['new_connection']} reuse_ratio={reuse_ratio:.2f}"
+        )
+        sentry_sdk.set_measurement("openai.latency", latency * 1000, "millisecond")
+        sentry_sdk.set_measurement("openai.connection_reuse_ratio", reuse_ratio)
+
+
+# APIキーごとにOpenAIクライアントを保持し、コンテナ内でHTTP接続を使い回すクラスです。
+class OpenAIClientRegistry:
+    def __init__(self) -> None:
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.stats = ConnectionStats()
+
+    def _create_client(self, api_key):
+        http_client = httpx.Client(
+            http2=True,
+            timeout=OPENAI_TIMEOUT,
+            limits=httpx.Limits(
+                max_connections=OPENAI_MAX_CONNECTIONS,
+                max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+            ),
+            event_hooks={
+                "request": [self.stats.on_request],
+                "response": [self.stats.on_response],
+            },
+        )
+        return OpenAI(
+            timeout=OPENAI_TIMEOUT,
+            max_retries=3,
+            api_key=api_key,
+            http_client=http_client,
+        )
+
+    # 一定時間使われていないクライアントを破棄します。
+    def _evict_idle(self, now):
+        for api_key, (client, last_used) in list(self.clients.items()):
+            if now - last_used > OPENAI_CLIENT_IDLE_TTL:
+                del self.clients[api_key]
+                client.close()
+
+    # APIキーに対応するクライアントを取得します。
+    def get(self, api_key):
+        now = time.time()
+        with self.lock:
+            self._evict_idle(now)
+            entry = self.clients.get(api_key)
+            client = entry[0] if entry is not None else self._create_client(api_key)
+            self.clients[api_key] = (client, now)
+        return client
+
+
+# コンテナ全体で共有するOpenAIクライアント
+openai_clients = OpenAIClientRegistry()
+
+# assistant_id -> 最後に反映したアシスタントの状態
+assistant_states = {}
+# file_id -> ファイル名 (ファイル名は変更されないため期限を設けない)
+file_names = {}
+
+
+# ツールの構成を比較できる形にします。(APIが返す未設定の値はNoneになるため取り除く)
+def normalize_tools(tools):
+    def strip_none(value):
+        if isinstance(value, dict):
+            return {k: strip_none(v) for k, v in value.items() if v is not None}
+        if isinstance(value, list):
+            return [strip_none(v) for v in value]
+        return value
+
+    return json.dumps(strip_none(list(tools)), sort_keys=True)
+
+
 # ツール呼び出しの結果を処理し、必要なアクションがある場合はそれを実行します。
 # 参考: https://github.com/Azure-Samples/azureai-assistant-tool/blob/c5878d4a5d56bdc96ba10a8eff41bdfd7cf00770/sdk/azure-ai-assistant/azure/ai/assistant/management/assistant_client.py#L505
-def tool_call_handler(run, client, thread_store, message_callback, step_callback):
+def tool_call_handler(
+    run, client, thread_store, message_callback, step_callback, cost_ledger=None
+):
     if (
         not hasattr(run, "required_action")
         or not hasattr(run.required_action, "submit_tool_outputs")
         or run.required_action.type != "submit_tool_outputs"
     ):
         return
-    tool_outputs = []
-    for tool_call in run.required_action.submit_tool_outputs.tool_calls:
-        tool_id = tool_call.id
-        result = step_callback.function_call(
+    tool_calls = run.required_action.submit_tool_outputs.tool_calls
+    # 呼び出しの通知はツール呼び出しの順番で先に投稿する
+    status_ts = [
+        step_callback.start_function_call(
             tool_call.function.name, tool_call.function.arguments
         )
+        for tool_call in tool_calls
+    ]
+    # ツールを並列に呼び出す
+    start_time = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=TOOL_CALL_WORKERS)
+    futures = [
+        executor.submit(
+            step_callback.function_call,
+            tool_call.function.name,
+            tool_call.function.arguments,
+            ts,
+        )
+        for tool_call, ts in zip(tool_calls, status_ts)
+    ]
+    tool_outputs = []
+    for i, (tool_call, future) in enumerate(zip(tool_calls, futures)):
+        # 空きを待つツールがあるため、実行される順番に応じて期限を延ばす
+        deadline = start_time + TOOL_CALL_TIMEOUT * (i // TOOL_CALL_WORKERS + 1)
+        try:
+            result = future.result(timeout=max(deadline - time.perf_counter(), 0))
+        except TimeoutError:
+            logging.error(f"tool call timed out: {tool_call.function.name}")
+            result = f"{tool_call.function.name} timed out"
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            logging.exception(e)
+            result = f"{tool_call.function.name} failed: {e}"
         tool_outputs.append(
             {
-                "tool_call_id": tool_id,
+                "tool_call_id": tool_call.id,
                 "output": result,
             }
         )
+    # タイムアウトしたツールの終了は待たない
+    executor.shutdown(wait=False, cancel_futures=True)
+    logging.info(
+        f"tool calls: {len(tool_calls)} time={time.perf_counter() - start_time:.2f}s"
+    )
     with client.beta.threads.runs.submit_tool_outputs_stream(
         thread_id=run.thread_id,
         run_id=run.id,
         tool_outputs=tool_outputs,
         event_handler=SlackAssistantEventHandler(
-            client, thread_store, message_callback, step_callback
+            client, thread_store, message_callback, step_callback, cost_ledger
         ),
     ) as stream:
         stream.until_done()
@@ -81,8 +248,11 @@ def tool_call_handler(run, client, thread_store, message_callback, step_callback
 # イベントハンドラーのクラスです。OpenAI Assistantからのイベントを処理します。
 # 参考: https://github.com/openai/openai-python/blob/main/helpers.md
 class SlackAssistantEventHandler(AssistantEventHandler):
-    def __init__(self, client, thread_store, message_callback, step_callback) -> None:
+    def __init__(
+        self, client, thread_store, message_callback, step_callback, cost_ledger=None
+    ) -> None:
         super().__init__()
+        self.cost_ledger = cost_ledger
         self.message_callback = message_callback
         self.step_callback = step_callback
         self.client = client
@@ -164,8 +334,25 @@ class SlackAssistantEventHandler(AssistantEventHandler):
                 self.thread_store,
                 self.message_callback,
                 self.step_callback,
+                self.cost_ledger,
             )
 
+    # 完了したRunのトークン使用量をコスト台帳とスレッドのカウンタに加算します。
+    def record_usage(self, run):
+        if run.usage is None:
+            return
+        try:
+            self.thread_store.add_run(
+                run.usage.prompt_tokens, run.usage.completion_tokens
+            )
+            if self.cost_ledger is not None:
+                self.cost_ledger.add_usage(
+                    run.model, run.usage.prompt_tokens, run.usage.completion_tokens
+                )
+        except Exception as e:
+            sentry_sdk.capture_exception(e)
+            logging.exception(e)
+
     # タイムアウト時の処理を行います。
     @override
     def on_timeout(self):
@@ -181,6 +368,7 @@ class SlackAssistantEventHandler(AssistantEventHandler):
     @override
     def on_event(self, event: AssistantStreamEvent) -> None:
         if event.event == "thread.run.completed":
+            self.record_usage(event.data)
             self.message_callback.end()
 
         if event.event == "thread.run.failed":
@@ -191,17 +379,43 @@ class SlackAssistantEventHandler(AssistantEventHandler):
             self.thread_store.update_run_id(run_id)
 
 
+# モデルとトークン数からコストを計算します。
+def calculate_cost(model, prompt_tokens, completion_tokens):
+    try:
+        cost_per_completion_token = get_openai_token_cost_for_model(
+            model,
+            num_tokens=completion_tokens,
+            is_completion=True,
+        )
+        cost_per_token = get_openai_token_cost_for_model(
+            model,
+            num_tokens=prompt_tokens,
+            is_completion=False,
+        )
+    except Exception as e:
+        # 料金が不明なモデルは1kトークンあたりの概算で計算する
+        cost_per_completion_token = completion_tokens / 1000 * 0.03
+        cost_per_token = prompt_tokens / 1000 * 0.01
+    return cost_per_token + cost_per_completion_token
+
+
 class AssistantAPIClient:
     def __init__(self, api_key) -> None:
         self.api_key = api_key
-        self.client = OpenAI(timeout=20.0, max_retries=3, api_key=self.api_key)
 
-    def create_thread(self):
-        return self.client.beta.threads.create()
+    # 共有のOpenAIクライアントを取得します。
+    @property
+    def client(self):
+        return openai_clients.get(self.api_key)
+
+    def create_thread(self, messages=None):
+        if messages is None:
+            return self.client.beta.threads.create()
+        return self.client.beta.threads.create(messages=messages)
 
-    def get_ai_thread_messages(self, thread_id):
+    def get_ai_thread_messages(self, thread_id, order="desc"):
         return list(
-            self.client.beta.threads.messages.list(thread_id=thread_id, order="desc")
+            self.client.beta.threads.messages.list(thread_id=thread_id, order=order)
         )
 
     def create_assistant(self, name, instructions=""):
@@ -213,12 +427,40 @@ class AssistantAPIClient:
         )
         return assistant.id
 
+    # file_idからファイル名を取得します。取得済みのファイル名は再利用します。
+    def get_file_names(self, file_ids):
+        filenames = []
+        for file_id in file_ids:
+            if file_id not in file_names:
+                file_names[file_id] = self.client.files.retrieve(file_id).filename
+            filenames.append(file_names[file_id])
+        return filenames
+
+    # キャッシュされたアシスタントの状態を取得します。期限切れの場合はNoneを返します。
+    def get_assistant_state(self, assistant_id):
+        state = assistant_states.get(assistant_id)
+        if state is None or state["expires_at"] < time.time():
+            return None
+        return state
+
+    def set_assistant_state(self, assistant_id, model, instructions, tools, file_ids):
+        assistant_states[assistant_id] = {
+            "model": model,
+            "instructions": instructions,
+            "tools": tools,
+            "file_ids": list(file_ids),
+            "expires_at": time.time() + ASSISTANT_STATE_TTL,
+        }
+
     def get_assistant_filenames(self, assistant_id):
         filenames = []
         try:
-            for file_id in self.client.beta.assistants.retrieve(assistant_id).file_ids:
-                filename = self.client.files.retrieve(file_id).filename
-                filenames.append(filename)
+            state = self.get_assistant_state(assistant_id)
+            if state is not None:
+                file_ids = state["file_ids"]
+            else:
+                file_ids = self.client.beta.assistants.retrieve(assistant_id).file_ids
+            filenames = self.get_file_names(file_ids)
         except Exception as e:
             logging.exception(e)
         return filenames
@@ -229,6 +471,8 @@ class AssistantAPIClient:
             current_assistant = assistant.model_dump()
             file_ids = current_assistant.get("file_ids", [])
             self.client.beta.assistants.update(assistant_id, file_ids=[], tools=[])
+            assistant_states.pop(assistant_id, None)
+            upload_manager.invalidate(file_ids)
             for file_id in file_ids:
                 logging.info(f"delete {file_id}")
                 self.client.files.delete(file_id)
@@ -253,13 +497,12 @@ class AssistantAPIClient:
         return tools
 
     def update_knowledge_files(self, knowledge_files, file_ids=[]):
-        for knowledge_file in knowledge_files:
-            logging.info(f"update knowledge: {knowledge_file}")
-            file = self.client.files.create(
-                file=open(knowledge_file, "rb"), purpose="assistants"
-            )
-            logging.info(f"add knowledge file: {knowledge_file} -> {file.id}")
-            file_ids.append(file.id)
+        file_ids = list(file_ids)
+        new_file_ids = upload_manager.upload(self.client, self.api_key, knowledge_files)
+        for knowledge_file, file_id in zip(knowledge_files, new_file_ids):
+            logging.info(f"add knowledge file: {knowledge_file} -> {file_id}")
+            if file_id not in file_ids:
+                file_ids.append(file_id)
         return file_ids
 
     def get_assistant(self, assistant_id):
@@ -275,9 +518,10 @@ class AssistantAPIClient:
         model=BASE_MODEL,
         tools=None,
     ):
+        # 他のコンテナが更新している場合があるため、常に最新のアシスタントを元に更新する
         current_assistant = self.get_assistant(assistant_id)
         logging.info(f"current_assistant: {current_assistant}")
-        file_ids = current_assistant.get("file_ids", [])
+        file_ids = list(current_assistant.get("file_ids", []))
         # Assistantを初期化しない場合はツールを追記する
         # 既存のツールの構成を更新する
         new_tools = tools if tools is not None else current_assistant["tools"]
@@ -286,8 +530,24 @@ class AssistantAPIClient:
             current_assistant["instructions"] if instructions is None else instructions
         )
 
+        # アップロード済みのファイルはキャッシュのfile_idが使われる
+        live_file_ids = file_ids
         file_ids = self.update_knowledge_files(knowledge_files, file_ids)
 
+        # 最新のアシスタントと設定が変わっていない場合は更新しない
+        if (
+            sorted(file_ids) == sorted(live_file_ids)
+            and current_assistant["model"] == model
+            and current_assistant["instructions"] == new_instructions
+            and normalize_tools(current_assistant["tools"])
+            == normalize_tools(new_tools)
+        ):
+            logging.info(f"skip update assistant: {assistant_id}")
+            self.set_assistant_state(
+                assistant_id, model, new_instructions, new_tools, file_ids
+            )
+            return self.get_file_names(file_ids)
+
         logging.info(f"update tools: {new_tools}")
 
         new_assistant = self.client.beta.assistants.update(
@@ -297,21 +557,32 @@ class AssistantAPIClient:
             model=model,
             tools=new_tools,
         )
-        filenames = []
-        for file_id in new_assistant.file_ids:
-            filename = self.client.files.retrieve(file_id).filename
-            filenames.append(filename)
-
-        return filenames
+        self.set_assistant_state(
+            assistant_id, model, new_instructions, new_tools, new_assistant.file_ids
+        )
+        return self.get_file_names(new_assistant.file_ids)
 
     def create_message(self, thread_id, content, files=[], role="user"):
-        file_ids = []
-        for file in files:
-            file = self.client.files.create(file=open(file, "rb"), purpose="assistants")
-            file_ids.append(file.id)
-        return self.client.beta.threads.messages.create(
-            thread_id=thread_id, role=role, content=content, file_ids=file_ids
+        # 同じ内容のファイルは1つのfile_idにまとめる
+        file_ids = list(
+            dict.fromkeys(upload_manager.upload(self.client, self.api_key, files))
         )
+        try:
+            return self.client.beta.threads.messages.create(
+                thread_id=thread_id, role=role, content=content, file_ids=file_ids
+            )
+        except (NotFoundError, BadRequestError) as e:
+            if len(file_ids) == 0 or "file" not in str(e).lower():
+                raise
+            # キャッシュしたfile_idのファイルが削除されている場合はアップロードし直す
+            logging.warning(f"uploaded file not found, upload again: {e}")
+            upload_manager.invalidate(file_ids)
+            file_ids = list(
+                dict.fromkeys(upload_manager.upload(self.client, self.api_key, files))
+            )
+            return self.client.beta.threads.messages.create(
+                thread_id=thread_id, role=role, content=content, file_ids=file_ids
+            )
 
     def cancel_run(self, thread_id, run_id):
         logging.info(f"cancel {run_id}:{thread_id}")
@@ -325,15 +596,26 @@ class AssistantAPIClient:
         message_callback,
         step_callback,
         additional_instructions,
+        cost_ledger=None,
+        overrides=None,
     ):
         try:
 
             assistant_id = assistant.get_assistant_id()
+            # Run単位で上書きする設定 (model, instructions, tools)
+            run_params = dict(overrides or {})
+            if additional_instructions:
+                run_params["additional_instructions"] = additional_instructions
             with self.client.beta.threads.runs.create_and_stream(
                 thread_id=th.thread_id,
                 assistant_id=assistant_id,
+                **run_params,
                 event_handler=SlackAssistantEventHandler(
-                    self.client, thread_store, message_callback, step_callback
+                    self.client,
+                    thread_store,
+                    message_callback,
+                    step_callback,
+                    cost_ledger,
                 ),
             ) as stream:
                 stream.until_done()
@@ -346,28 +628,15 @@ class AssistantAPIClient:
         params = {"date": date}
         total_cost = 0
         try:
-            response = requests.get(url, headers=headers, params=params)
+            response = requests.get(url, headers=headers, params=params, timeout=30)
             response.raise_for_status()
             response = response.json()
             usage_data = response["data"]
             for record in usage_data:
-                model = record["snapshot_id"]
-                try:
-                    cost_per_completion_token = get_openai_token_cost_for_model(
-                        model,
-                        num_tokens=record["n_generated_tokens_total"],
-                        is_completion=True,
-                    )
-                    cost_per_token = get_openai_token_cost_for_model(
-                        model,
-                        num_tokens=record["n_context_tokens_total"],
-                        is_completion=False,
-                    )
-                except Exception as e:
-                    cost_per_completion_token = 0.03
-                    cost_per_token = 0.01
-                total_cost += (
-                    cost_per_token + cost_per_completion_token
+                total_cost += calculate_cost(
+                    record["snapshot_id"],
+                    record["n_context_tokens_total"],
+                    record["n_generated_tokens_total"],
                 )  # トータルコストの計算
         except Exception as e:
             print(f"OpenAI APIのレスポンス処理中にエラーが発生しました: {e}")
@@ -1,7 +1,9 @@
 # 参考
 # https://qiita.com/seratch/items/12b39d636daf8b1e5fbf
 import os
+import json
 import yara
+import base64
 import logging
 import sentry_sdk
 from sentry_sdk import set_user, set_tag
@@ -12,6 +14,8 @@ from slack_bolt.adapter.aws_lambda import SlackRequestHandler
 from slack_bolt.context import BoltContext
 from ui import generate_unfurl_message, generate_home, generate_select_assistant_block
 from store import Assistant, ThreadStore, publish_event
+from assistant_config import assistant_registry
+from idempotency import IdempotencyStore, event_key
 from slacklib import (
     get_thread_messages,
     add_reaction,
@@ -45,6 +49,9 @@ yara_rule_file = "/function/data/auto_reply.yara"
 # YARAファイルからルールをコンパイル
 auto_reply_rules = yara.compile(filepath=yara_rule_file)
 
+# Slackから再送されたイベントの重複排除
+publish_events = IdempotencyStore(scope="publish")
+
 app = App(
     token=SLACK_BOT_TOKEN,
     signing_secret=SLACK_SIGNING_SECRET,
@@ -84,7 +91,7 @@ def shortcut_update_assistant(ack, shortcut, client):
             "title": {"type": "plain_text", "text": "アシスタントの変更"},
             "close": {"type": "plain_text", "text": "Close"},
             "submit": {"type": "plain_text", "text": "update"},
-            "blocks": generate_select_assistant_block(),
+            "blocks": generate_select_assistant_block(assistant_registry.all()),
         },
     )
 
@@ -274,7 +281,7 @@ def update_home_tab(client, event, logger):
     user_id = event["user"]
     assistant = Assistant(user_id)
     assistant_name = assistant.get_assistant_name()
-    payload = generate_home(assistant_name)
+    payload = generate_home(assistant_name, assistant_registry.all())
     client.views_publish(user_id=event["user"], view=payload)
 
 
@@ -305,8 +312,8 @@ def handle_message(message, context: BoltContext, client: WebClient):
     # DMまたはメンション付きのメッセージでなければ無視
     if not f"<@{BOT_USER_ID}>" in message_text and channel_type != "im":
         return
-    # 既読リアクション
-    client.reactions_add(name="eyes", channel=channel_id, timestamp=event_ts)
+    # 既読リアクション (再送で既にリアクション済みの場合も処理を続ける)
+    add_reaction("eyes", channel_id, event_ts)
     # 誤送信防止
     if len(message_text.replace(f"<@{BOT_USER_ID}>", "").strip()) < 10:
         text = f"<@{user_id}>メッセージが短すぎます。"
@@ -318,15 +325,45 @@ def handle_message(message, context: BoltContext, client: WebClient):
             thread_ts=thread_ts,
         )
         return
-    publish_event(message)
+    # Slackからの再送などで既に受け付けたイベントは無視する
+    key = event_key(message)
+    if not publish_events.claim(key):
+        return
+    try:
+        publish_event(message)
+    except Exception:
+        # 送信に失敗した場合はSlackの再送で処理できるように受け付けを取り消す
+        publish_events.release(key)
+        raise
 
 
 slack_handler = SlackRequestHandler(app=app)
 
 
+# Slackから再送されたメッセージイベントが既に受け付け済みかどうかを判定します。
+def is_claimed_retry(event):
+    try:
+        body = event.get("body") or ""
+        if event.get("isBase64Encoded"):
+            body = base64.b64decode(body).decode()
+        slack_event = json.loads(body).get("event", {})
+    except ValueError:
+        return False
+    if slack_event.get("type") != "message":
+        return False
+    return publish_events.is_claimed(event_key(slack_event))
+
+
 def handler(event, context):
     if "X-Slack-Signature" not in event["headers"]:
         return {"statusCode": 400, "body": "Verification failed"}
+    retry_num = event["headers"].get("X-Slack-Retry-Num")
+    if retry_num is not None:
+        retry_reason = event["headers"].get("X-Slack-Retry-Reason")
+        logging.info(f"slack retry: {retry_num} ({retry_reason})")
+        # 既に受け付けたイベントの再送はBoltの処理を行わずに応答する
+        if is_claimed_retry(event):
+            return {"statusCode": 200, "body": ""}
     try:
         res = slack_handler.handle(event, context)
         return res
@@ -0,0 +1,84 @@
+import os
+import copy
+import yaml
+import logging
+import threading
+from types import MappingProxyType
+from ui import generate_faq_block
+
+ASSISTANT_FILE = "/function/data/assistant.yml"
+DATA_DIR = "/function/data"
+DEFAULT_INSTRUCTIONS = "あなたはユーザに質問に回答するアシスタントです"
+
+
+# assistant.ymlの1件分の設定から、メッセージごとに必要な値を事前に組み立てます。
+def build_assistant_entry(assistant, data_dir=DATA_DIR):
+    tools = tuple(assistant.get("tools", []))
+    faq = tuple(assistant.get("faq", []))
+    faq_blocks = ()
+    if len(faq) > 0:
+        # generate_faq_blockは引数を書き換えるためコピーを渡す
+        faq_blocks = tuple(generate_faq_block(copy.deepcopy(list(faq))))
+    files = []
+    for file in assistant.get("files", []):
+        filename = os.path.join(data_dir, file)
+        if os.path.exists(filename):
+            files.append(filename)
+    return MappingProxyType(
+        {
+            "name": assistant.get("name", ""),
+            "model": assistant.get("model", ""),
+            "instructions": assistant.get("instructions") or DEFAULT_INSTRUCTIONS,
+            "additional_instructions": "",
+            "tools": tools,
+            "function_names": tuple(
+                tool["function"]["name"] for tool in tools if tool["type"] == "function"
+            ),
+            "faq": faq,
+            "faq_blocks": faq_blocks,
+            "files": tuple(files),
+            "urls": tuple(assistant.get("urls", [])),
+        }
+    )
+
+
+# assistant.ymlをコンテナごとに一度だけ読み込み、更新された場合のみ再読み込みするクラスです。
+class AssistantConfigRegistry:
+    def __init__(self, path=ASSISTANT_FILE, data_dir=DATA_DIR) -> None:
+        self.path = path
+        self.data_dir = data_dir
+        self.mtime = None
+        self.entries = MappingProxyType({})
+        self.lock = threading.Lock()
+
+    def _reload_if_changed(self):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime == self.mtime:
+            return
+        with self.lock:
+            if mtime == self.mtime:
+                return
+            with open(self.path, "r") as f:
+                assistant_data = yaml.safe_load(f)
+            self.entries = MappingProxyType(
+                {
+                    name: build_assistant_entry(assistant, self.data_dir)
+                    for name, assistant in assistant_data.items()
+                }
+            )
+            self.mtime = mtime
+            logging.info(f"load assistant config: {self.path}")
+
+    # アシスタント名から読み取り専用の設定を取得します。
+    def get(self, assistant_name):
+        self._reload_if_changed()
+        return self.entries[assistant_name]
+
+    # 全てのアシスタントの読み取り専用の設定を取得します。
+    def all(self):
+        self._reload_if_changed()
+        return self.entries
+
+
+# コンテナ全体で共有するアシスタント設定
+assistant_registry = AssistantConfigRegistry()
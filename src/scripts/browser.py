@@ -0,0 +1,136 @@
+import os
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.support.ui import WebDriverWait
+
+# コンテナ内で保持するブラウザの数 (0の場合は毎回ブラウザを起動して終了する)
+BROWSER_POOL_SIZE = int(os.getenv("BROWSER_POOL_SIZE", "1"))
+# 同じブラウザを再利用する回数の上限
+BROWSER_MAX_USES = int(os.getenv("BROWSER_MAX_USES", "20"))
+WEBDRIVER_TIMEOUT = 10
+WEBDRIVER_ARGUMENTS = (
+    "--headless",
+    "--no-sandbox",
+    "--single-process",
+    "--disable-dev-shm-usage",
+    "--disable-gpu",
+    "--disable-extensions",
+    "--disk-cache-size=0",
+    "--aggressive-cache-discard",
+    "--disable-notifications",
+    "--disable-remote-fonts",
+    "--window-size=1366,768",
+    "--hide-scrollbars",
+    "--disable-audio-output",
+)
+
+
+# Selenium WebDriverを起動します。
+def create_driver():
+    options = webdriver.ChromeOptions()
+    service = webdriver.ChromeService("/opt/chromedriver-linux64/chromedriver")
+    options.binary_location = "/opt/chrome-linux64/chrome"
+    for opt in WEBDRIVER_ARGUMENTS:
+        options.add_argument(opt)
+    driver = webdriver.Chrome(options=options, service=service)
+    driver.set_page_load_timeout(WEBDRIVER_TIMEOUT)
+    return driver
+
+
+# ページの読み込みが完了するまで待機します。
+# ready_scriptが指定された場合はそのJavaScriptがtrueを返すまで待機します。
+def wait_until_ready(driver, ready_script=None, timeout=WEBDRIVER_TIMEOUT):
+    def is_ready(d):
+        if d.execute_script("return document.readyState") != "complete":
+            return False
+        return ready_script is None or bool(d.execute_script(ready_script))
+
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=0.2).until(is_ready)
+        return True
+    except TimeoutException:
+        logging.warning(f"page is not ready in {timeout}s: {driver.current_url}")
+        return False
+
+
+# ヘッドレスChromeを使い回すためのプールです。
+# 一定回数使用したブラウザやクラッシュしたブラウザは破棄して作り直します。
+class BrowserPool:
+    def __init__(self, size=BROWSER_POOL_SIZE, max_uses=BROWSER_MAX_USES) -> None:
+        self.size = size
+        self.max_uses = max_uses
+        self.idle = []
+        self.lock = threading.Lock()
+        self.semaphore = threading.BoundedSemaphore(max(size, 1))
+
+    # プールからブラウザを取り出します。
+    def _acquire(self):
+        while True:
+            with self.lock:
+                entry = self.idle.pop() if self.idle else None
+            if entry is None:
+                return {"driver": create_driver(), "uses": 0}
+            try:
+                # ブラウザが応答するか確認する
+                entry["driver"].current_url
+                return entry
+            except WebDriverException:
+                logging.info("discard crashed browser")
+                self._quit(entry)
+
+    # ブラウザをプールに戻します。
+    def _release(self, entry):
+        if self.size == 0 or entry["uses"] >= self.max_uses:
+            logging.info(f"recycle browser after {entry['uses']} uses")
+            self._quit(entry)
+            return
+        try:
+            entry["driver"].delete_all_cookies()
+            entry["driver"].get("about:blank")
+        except WebDriverException:
+            self._quit(entry)
+            return
+        with self.lock:
+            self.idle.append(entry)
+
+    def _quit(self, entry):
+        try:
+            entry["driver"].quit()
+        except Exception as e:
+            logging.error(e)
+
+    # ブラウザを貸し出します。
+    @contextmanager
+    def driver(self):
+        self.semaphore.acquire()
+        entry = None
+        try:
+            entry = self._acquire()
+            entry["uses"] += 1
+            yield entry["driver"]
+        except WebDriverException:
+            # クラッシュしたブラウザはプールに戻さない
+            if entry is not None:
+                self._quit(entry)
+                entry = None
+            raise
+        finally:
+            if entry is not None:
+                self._release(entry)
+            self.semaphore.release()
+
+    # プール内の全てのブラウザを終了します。
+    def close(self):
+        with self.lock:
+            entries, self.idle = self.idle, []
+        for entry in entries:
+            self._quit(entry)
+
+
+# コンテナ全体で共有するブラウザプール
+browser_pool = BrowserPool()
+atexit.register(browser_pool.close)
@@ -3,6 +3,7 @@ import sys
 import time
 import json
 import logging
+import threading
 import sentry_sdk
 from pluginbase import PluginBase
 from slacklib import post_message
@@ -10,9 +11,13 @@ from plugin import handle_output_plugin
 from slacklib import post_message, update_message, upload_file
 from ui import generate_step_block
 from tools import truncate_strings, calculate_token_size
+from tokenizer import TokenCounter
+from function_cache import function_cache, plugin_cache_ttl
 
 STREAM_RATE = 1
 SLACK_MAX_TOKEN_SIZE = 1500
+# コールドスタート時に関数プラグインを読み込むかどうか
+FUNCTION_PLUGIN_WARMUP = os.getenv("FUNCTION_PLUGIN_WARMUP", "false").lower() == "true"
 
 # PluginBase インスタンスを作成
 plugin_base = PluginBase(package="plugins")
@@ -20,6 +25,50 @@ plugin_base = PluginBase(package="plugins")
 function_source = plugin_base.make_plugin_source(searchpath=["./functions"])
 
 
+# 関数名から関数プラグインを引くための一覧をコンテナごとに一度だけ作成するクラスです。
+# 読み込みに失敗したプラグインはエラーを記録し、他のプラグインの読み込みを続けます。
+class FunctionRegistry:
+    def __init__(self, source) -> None:
+        self.source = source
+        self.functions = None
+        self.errors = {}
+        self.lock = threading.Lock()
+
+    # 全ての関数プラグインを読み込みます。読み込み済みの場合は何もしません。
+    def load(self):
+        if self.functions is not None:
+            return self.functions
+        with self.lock:
+            if self.functions is not None:
+                return self.functions
+            start_time = time.perf_counter()
+            functions = {}
+            for plugin_name in self.source.list_plugins():
+                try:
+                    functions[plugin_name] = self.source.load_plugin(plugin_name)
+                except Exception as e:
+                    sentry_sdk.capture_exception(e)
+                    logging.error(f"failed to load function plugin {plugin_name}: {e}")
+                    self.errors[plugin_name] = e
+            self.functions = functions
+            logging.info(
+                f"load {len(functions)} function plugins "
+                f"(errors: {list(self.errors)}) "
+                f"time={time.perf_counter() - start_time:.2f}s"
+            )
+        return self.functions
+
+    # 関数名に対応するプラグインモジュールを取得します。
+    def get(self, function_name):
+        return self.load().get(function_name)
+
+
+function_registry = FunctionRegistry(function_source)
+# コールドスタート時に関数プラグインを読み込んでおく
+if FUNCTION_PLUGIN_WARMUP:
+    function_registry.load()
+
+
 # Slackへのメッセージコールバックを処理するクラスです。
 class MessageCallback:
     def __init__(self, channel_id, message_ts) -> None:
@@ -30,6 +79,7 @@ class MessageCallback:
         self.ts = 0
         self.last_update_time = 0
         self.current_message = ""
+        self.token_counter = TokenCounter()
 
     # メッセージの作成を行います。
     def create(self) -> None:
@@ -48,12 +98,14 @@ class MessageCallback:
     # メッセージを更新します。
     def update(self, message: str) -> None:
         current_time = time.time()
-        output_token = calculate_token_size(self.current_message + message)
+        # 差分だけをエンコードしてトークン数を更新する
+        output_token = self.token_counter.add(message)
         if output_token > SLACK_MAX_TOKEN_SIZE or self.ts == 0:
             if output_token > SLACK_MAX_TOKEN_SIZE:
                 update_message(self.channel_id, self.ts, self.current_message)
             self.create()
             self.current_message = message
+            self.token_counter.reset(message)
         else:
             self.current_message += message
 
@@ -82,6 +134,7 @@ class StepCallback:
         self.ts = 0
         self.last_update_time = 0
         self.current_message = ""
+        self.token_counter = TokenCounter()
 
     # コード入力の開始を通知します。
     def create(self) -> None:
@@ -96,12 +149,14 @@ class StepCallback:
     # メッセージを更新します。
     def update(self, message: str) -> None:
         current_time = time.time()
-        output_token = calculate_token_size(self.current_message + message)
+        # 差分だけをエンコードしてトークン数を更新する
+        output_token = self.token_counter.add(message)
         if output_token > SLACK_MAX_TOKEN_SIZE or self.ts == 0:
             if output_token > SLACK_MAX_TOKEN_SIZE:
                 self._update_code_message(self.current_message)
             self.create()
             self.current_message = message
+            self.token_counter.reset(message)
         else:
             self.current_message += message
 
@@ -109,47 +164,54 @@ class StepCallback:
             self._update_code_message(self.current_message)
             self.last_update_time = current_time
 
+    def _function_call_message(self, function_name, arguments):
+        argument_truncated = truncate_strings(arguments, max_tokens=20)
+        return f"call: `{function_name}({argument_truncated})`\n"
+
+    # 関数呼び出しの開始を通知し、通知したメッセージのtsを返します。
+    def start_function_call(self, function_name, arguments):
+        message = self._function_call_message(function_name, arguments)
+        res = post_message(self.channel_id, self.message_ts, message)
+        return res["ts"]
+
     # 関数呼び出しを行います。
-    def function_call(self, function_name, arguments) -> None:
-        self.create()
+    # 並列に呼び出せるように、tsを指定した場合はstart_function_callで通知したメッセージを更新します。
+    def function_call(self, function_name, arguments, ts=None) -> None:
+        if ts is None:
+            ts = self.start_function_call(function_name, arguments)
         argument = json.loads(arguments)
-        argument_truncated = truncate_strings(arguments, max_tokens=20)
-        message = f"call: `{function_name}({argument_truncated})`\n"
-        update_message(self.channel_id, self.ts, message)
+        message = self._function_call_message(function_name, arguments)
 
-        # プラグインとその優先度を格納するリスト
-        plugins_with_priority = []
-        for plugin_name in function_source.list_plugins():
-            # プラグインの優先度を取得（デフォルトは最低優先度）
-            plugin_module = function_source.load_plugin(plugin_name)
-            priority = getattr(plugin_module, "PRIORITY", float("inf"))
-            # プラグインとその優先度をリストに追加
-            plugins_with_priority.append((priority, plugin_name))
         result = ""
-        # 優先度に基づいてプラグインをソート
-        plugins_with_priority.sort()
-        # ソートされた順序でプラグインを実行
-        for _, plugin_name in plugins_with_priority:
-            # プラグインをロード
-            plugin_module = function_source.load_plugin(plugin_name)
-            if function_name == plugin_name:
+        plugin_module = function_registry.get(function_name)
+        if plugin_module is None:
+            logging.error(f"function plugin not found: {function_name}")
+            if function_name in function_registry.errors:
+                result = f"{function_name} failed to load: {function_registry.errors[function_name]}"
+        else:
+            # 同じ引数の結果がキャッシュされていればプラグインを呼び出さない
+            ttl = plugin_cache_ttl(plugin_module)
+            if ttl > 0:
+                result = function_cache.get(function_name, arguments) or ""
+            if len(result) == 0:
                 try:
-                    logging.info(f"run extractor {plugin_name}")
+                    logging.info(f"run extractor {function_name}")
                     # プラグインモジュールから関数を呼び出す
                     plugin_result = plugin_module.run(**argument)
                     # 8kになるように切り捨てする
                     result = truncate_strings(plugin_result, max_tokens=16000)
+                    if ttl > 0 and len(result) > 0:
+                        function_cache.set(function_name, arguments, result, ttl)
                 except Exception as e:
                     sentry_sdk.capture_exception(e)
                     logging.exception(e)
-                break
         if len(result) == 0:
             result = "no result"
         output_token = calculate_token_size(result)
         message += (
             f"`{function_name}`を実行しました。結果のトークン数: {output_token}\n"
         )
-        update_message(self.channel_id, self.ts, message)
+        update_message(self.channel_id, ts, message)
         return result
 
     # 出力を設定します。
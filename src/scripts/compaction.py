@@ -0,0 +1,120 @@
+import os
+import time
+import logging
+import tokenizer
+from ai import BASE_MODEL
+
+# スレッドのトークン数がこの値を超えたら要約する (0の場合は要約しない)
+COMPACTION_MAX_TOKENS = int(os.getenv("COMPACTION_MAX_TOKENS", "0"))
+# 要約せずに残す直近の会話数 (ユーザの質問とその回答を1ターンとする)
+COMPACTION_KEEP_TURNS = int(os.getenv("COMPACTION_KEEP_TURNS", "3"))
+# 要約に使うモデル
+COMPACTION_MODEL = os.getenv("COMPACTION_MODEL", BASE_MODEL)
+# 要約するモデルに渡すトークン数の上限
+COMPACTION_INPUT_MAX_TOKENS = 12000
+# 1メッセージに添付できるファイル数の上限
+MAX_MESSAGE_FILES = 10
+
+SUMMARY_HEADER = "# これまでの会話の要約\n"
+SUMMARY_INSTRUCTIONS = (
+    "以下はユーザとアシスタントの会話です。"
+    "今後の会話を続けるために必要な事実、決定事項、未解決の質問を漏らさずに簡潔に要約してください。"
+)
+
+
+# スレッドのトークン数が上限を超えているか判定します。
+def needs_compaction(doc, max_tokens=COMPACTION_MAX_TOKENS):
+    if max_tokens <= 0 or "message_count" not in doc:
+        return False
+    return int(doc.get("total_tokens", 0)) > max_tokens
+
+
+# OpenAI Threadのメッセージを {"role", "content", "file_ids"} の辞書に変換します。
+def to_turns(messages):
+    turns = []
+    for message in messages:
+        content = "\n".join(
+            item.text.value for item in message.content if item.type == "text"
+        )
+        turns.append(
+            {
+                "role": message.role,
+                "content": content,
+                "file_ids": list(message.file_ids or []),
+            }
+        )
+    return turns
+
+
+# 直近keep_turns回のユーザの質問以降を残し、それより前を要約の対象にします。
+def split_turns(turns, keep_turns=COMPACTION_KEEP_TURNS):
+    user_indexes = [i for i, turn in enumerate(turns) if turn["role"] == "user"]
+    if len(user_indexes) <= keep_turns:
+        return [], turns
+    index = user_indexes[-keep_turns] if keep_turns > 0 else len(turns)
+    return turns[:index], turns[index:]
+
+
+# 会話を要約します。
+def summarize(client, turns, model=COMPACTION_MODEL):
+    transcript = "".join(f"* {turn['role']}: {turn['content']}\n" for turn in turns)
+    transcript, _, _ = tokenizer.truncate(
+        transcript, COMPACTION_INPUT_MAX_TOKENS, model=model
+    )
+    response = client.client.chat.completions.create(
+        model=model,
+        messages=[
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": transcript},
+        ],
+    )
+    return response.choices[0].message.content
+
+
+# 要約と直近の会話から新しいスレッドの初期メッセージを組み立てます。
+# 要約したメッセージに添付されていたファイルは要約のメッセージに引き継ぎます。
+def build_seed_messages(summary, older, recent):
+    file_ids = [file_id for turn in older for file_id in turn["file_ids"]]
+    seed = [
+        {
+            "role": "user",
+            "content": SUMMARY_HEADER + summary,
+            "file_ids": file_ids[-MAX_MESSAGE_FILES:],
+        }
+    ]
+    for turn in recent:
+        if len(turn["content"]) == 0:
+            continue
+        seed.append(
+            {
+                "role": turn["role"],
+                "content": turn["content"],
+                "file_ids": turn["file_ids"][-MAX_MESSAGE_FILES:],
+            }
+        )
+    return seed
+
+
+# 長くなったOpenAI Threadを要約し、要約と直近の会話から始まる新しいスレッドに切り替えます。
+# 切り替えた場合は新しいThread IDを返します。
+def compact_thread(client, thread_store, doc, model=COMPACTION_MODEL):
+    start_time = time.perf_counter()
+    thread_id = doc["thread_id"]
+    turns = to_turns(client.get_ai_thread_messages(thread_id, order="asc"))
+    older, recent = split_turns(turns)
+    if len(older) == 0:
+        return None
+    summary = summarize(client, older, model=model)
+    seed = build_seed_messages(summary, older, recent)
+    total_tokens = sum(tokenizer.count(message["content"]) for message in seed)
+    thread = client.create_thread(messages=seed)
+    if not thread_store.replace_thread(doc, thread.id, len(seed), total_tokens):
+        logging.info(f"skip compaction {thread_id}: thread was updated")
+        return None
+    logging.info(
+        f"compact thread {thread_id} -> {thread.id} "
+        f"tokens={doc.get('total_tokens')}->{total_tokens} "
+        f"messages={len(turns)}->{len(seed)} "
+        f"time={time.perf_counter() - start_time:.2f}s"
+    )
+    return thread.id
@@ -0,0 +1,90 @@
+import os
+import json
+import time
+import logging
+import boto3
+from botocore.exceptions import ClientError
+
+DB_MESSAGE_TABLE = os.getenv("DB_MESSAGE_TABLE")
+# 同じスレッドで続けて送られたメッセージをまとめる秒数 (0の場合はまとめない)
+DEBOUNCE_SECONDS = float(os.getenv("DEBOUNCE_SECONDS", "0"))
+# まとめ中のメッセージを残しておく秒数
+DEBOUNCE_RETENTION = 60 * 60
+
+dynamodb = boto3.resource("dynamodb")
+
+
+# 続けて送られたメッセージの本文とファイルを1つのイベントにまとめます。
+def merge_events(events):
+    events = sorted(events, key=lambda e: float(e.get("ts", "0")))
+    merged = dict(events[-1])
+    merged["text"] = "\n".join(e["text"] for e in events if len(e.get("text", "")) > 0)
+    merged["files"] = [file for e in events for file in e.get("files", [])]
+    if len(merged["files"]) > 0:
+        merged["subtype"] = "file_share"
+    return merged
+
+
+# 一定時間内に同じスレッドに送られたメッセージを待ち、最後のメッセージの処理でまとめて回答するクラスです。
+# まとめ中のメッセージはスレッド情報とは別のアイテムに保存します。
+class MessageDebouncer:
+    def __init__(self, doc_id, seconds=DEBOUNCE_SECONDS, table=None):
+        self.doc_id = f"debounce_{doc_id}"
+        self.seconds = seconds
+        self.table = table or dynamodb.Table(DB_MESSAGE_TABLE)
+
+    # メッセージをユーザのまとめ中のメッセージに追加します。
+    def add(self, event):
+        user_id = event.get("user")
+        self.table.update_item(
+            Key={"doc_id": self.doc_id},
+            UpdateExpression=(
+                "SET #events = list_append(if_not_exists(#events, :empty), :e), "
+                "#latest = :ts, expires_at = :exp"
+            ),
+            ExpressionAttributeNames={
+                "#events": f"pending_events_{user_id}",
+                "#latest": f"pending_ts_{user_id}",
+            },
+            ExpressionAttributeValues={
+                ":e": [json.dumps(event)],
+                ":empty": [],
+                ":ts": event.get("ts"),
+                ":exp": int(time.time()) + DEBOUNCE_RETENTION,
+            },
+        )
+
+    # 指定したメッセージがユーザの最新のメッセージであれば、まとめ中のメッセージを全て取り出します。
+    # より新しいメッセージがある場合はNoneを返します。
+    def take(self, event):
+        user_id = event.get("user")
+        try:
+            response = self.table.update_item(
+                Key={"doc_id": self.doc_id},
+                UpdateExpression="REMOVE #events, #latest",
+                ConditionExpression="#latest = :ts",
+                ExpressionAttributeNames={
+                    "#events": f"pending_events_{user_id}",
+                    "#latest": f"pending_ts_{user_id}",
+                },
+                ExpressionAttributeValues={":ts": event.get("ts")},
+                ReturnValues="ALL_OLD",
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return None
+        events = response["Attributes"].get(f"pending_events_{user_id}", [])
+        return [json.loads(pending_event) for pending_event in events]
+
+    # メッセージを追加して待ち、最後のメッセージであればまとめたイベントを返します。
+    # より新しいメッセージがある場合はそちらで回答するためNoneを返します。
+    def debounce(self, event):
+        self.add(event)
+        time.sleep(self.seconds)
+        events = self.take(event)
+        if events is None:
+            logging.info(f"debounce: {event.get('ts')} is merged into a later message")
+            return None
+        logging.info(f"debounce: merge {len(events)} messages")
+        return merge_events(events)
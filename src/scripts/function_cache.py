@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+# 関数プラグインの結果を保存するディレクトリ
+FUNCTION_CACHE_DIR = os.getenv("FUNCTION_CACHE_DIR", "/tmp/function_cache")
+# プラグインがCACHE_TTLを定義していない場合に結果を再利用する秒数
+FUNCTION_CACHE_TTL = int(os.getenv("FUNCTION_CACHE_TTL", "300"))
+# メモリに保持する結果の件数
+FUNCTION_CACHE_SIZE = int(os.getenv("FUNCTION_CACHE_SIZE", "256"))
+# ディスク上のキャッシュの上限サイズ
+FUNCTION_CACHE_MAX_BYTES = int(
+    os.getenv("FUNCTION_CACHE_MAX_BYTES", str(50 * 1024 * 1024))
+)
+
+
+# プラグインモジュールのCACHE_TTLから結果を再利用する秒数を取得します。(0の場合はキャッシュしない)
+def plugin_cache_ttl(plugin_module):
+    return getattr(plugin_module, "CACHE_TTL", FUNCTION_CACHE_TTL)
+
+
+# 関数名と引数からキャッシュのキーを生成します。引数はキーの順番や空白の違いを無視します。
+def cache_key(function_name, arguments):
+    try:
+        normalized = json.dumps(
+            json.loads(arguments),
+            sort_keys=True,
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+    except ValueError:
+        normalized = arguments
+    return hashlib.sha256(f"{function_name}\0{normalized}".encode()).hexdigest()
+
+
+# 関数プラグインの結果をメモリとディスクの2段でキャッシュするクラスです。
+# 保存する結果は切り捨て後のものなので、ヒットした場合はプラグインの呼び出しと切り捨てを省略できます。
+class FunctionResultCache:
+    def __init__(
+        self,
+        cache_dir=FUNCTION_CACHE_DIR,
+        size=FUNCTION_CACHE_SIZE,
+        max_bytes=FUNCTION_CACHE_MAX_BYTES,
+    ):
+        self.cache_dir = cache_dir
+        self.size = size
+        self.max_bytes = max_bytes
+        # キー -> (有効期限, 結果)
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hit": 0, "disk_hit": 0, "miss": 0}
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def _remember(self, key, expires_at, result):
+        with self.lock:
+            self.memory[key] = (expires_at, result)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.size:
+                self.memory.popitem(last=False)
+
+    def _read_disk(self, key, now):
+        try:
+            with open(self._path(key), "r") as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if entry["expires_at"] <= now:
+            return None
+        self._remember(key, entry["expires_at"], entry["result"])
+        return entry["result"]
+
+    def _write_disk(self, key, function_name, expires_at, result):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with open(self._path(key), "w") as f:
+            json.dump(
+                {"function": function_name, "expires_at": expires_at, "result": result},
+                f,
+                ensure_ascii=False,
+            )
+        self._evict()
+
+    # 上限サイズを超えた場合は古いエントリから削除します。
+    def _evict(self):
+        with self.lock:
+            entries = []
+            total_size = 0
+            for name in os.listdir(self.cache_dir):
+                path = os.path.join(self.cache_dir, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+            entries.sort()
+            for _, size, path in entries:
+                if total_size <= self.max_bytes:
+                    break
+                os.remove(path)
+                total_size -= size
+
+    def _record(self, name, function_name):
+        with self.lock:
+            self.stats[name] += 1
+            total = sum(self.stats.values())
+            hit_rate = (self.stats["hit"] + self.stats["disk_hit"]) / total
+        logging.info(
+            f"function cache {name}: {function_name} "
+            f"hit_rate={hit_rate:.2f} ({self.stats})"
+        )
+
+    # キャッシュされた結果を取得します。見つからない場合はNoneを返します。
+    def get(self, function_name, arguments):
+        key = cache_key(function_name, arguments)
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None and entry[0] <= now:
+                del self.memory[key]
+                entry = None
+            if entry is not None:
+                self.memory.move_to_end(key)
+        if entry is not None:
+            self._record("hit", function_name)
+            return entry[1]
+        result = self._read_disk(key, now)
+        self._record("disk_hit" if result is not None else "miss", function_name)
+        return result
+
+    # 結果をttl秒間キャッシュします。
+    def set(self, function_name, arguments, result, ttl):
+        key = cache_key(function_name, arguments)
+        expires_at = time.time() + ttl
+        self._remember(key, expires_at, result)
+        try:
+            self._write_disk(key, function_name, expires_at, result)
+        except OSError as e:
+            logging.error(e)
+
+
+# コンテナ全体で共有する関数プラグインの結果のキャッシュ
+function_cache = FunctionResultCache()
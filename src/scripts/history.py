@@ -0,0 +1,64 @@
+import os
+import threading
+from collections import OrderedDict
+import tokenizer
+
+# スレッド履歴に使うトークン数の上限
+HISTORY_MAX_TOKENS = int(os.getenv("HISTORY_MAX_TOKENS", "8000"))
+# メッセージごとのトークン数を記憶する件数
+HISTORY_CACHE_SIZE = 10000
+ELISION_MARKER = "* (途中のメッセージを省略しました)\n"
+
+# (ts, model) -> (行, トークン数)
+_token_cache = OrderedDict()
+_token_cache_lock = threading.Lock()
+
+
+# メッセージを履歴の1行に変換し、トークン数と合わせて返します。トークン数はtsごとに記憶します。
+def tokenize_message(msg, model=None):
+    line = f"* <@{msg.get('user')}>: {msg.get('text')}\n"
+    key = (msg.get("ts"), model)
+    with _token_cache_lock:
+        cached = _token_cache.get(key)
+        if cached is not None and cached[0] == line:
+            _token_cache.move_to_end(key)
+            return cached
+    entry = (line, tokenizer.count(line, model=model))
+    with _token_cache_lock:
+        _token_cache[key] = entry
+        while len(_token_cache) > HISTORY_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+    return entry
+
+
+# スレッドのメッセージを新しいものから順にトークン数の上限まで詰め込みます。
+# 最初のメッセージは常に残し、省略したメッセージの位置には省略記号を入れます。
+# 戻り値は (履歴, トークン数, 切り捨てたトークン数)
+def pack_history(messages, max_tokens=HISTORY_MAX_TOKENS, model=None):
+    if len(messages) == 0:
+        return "", 0, 0
+    entries = [tokenize_message(msg, model) for msg in messages]
+    total_tokens = sum(tokens for _, tokens in entries)
+    if total_tokens <= max_tokens:
+        return "".join(line for line, _ in entries), total_tokens, 0
+
+    # 最初のメッセージ (長すぎる場合は切り捨てる)
+    opening, opening_tokens = entries[0]
+    marker_tokens = tokenizer.count(ELISION_MARKER, model=model)
+    budget = max(max_tokens - marker_tokens, 0)
+    if opening_tokens > budget:
+        opening, opening_tokens, _ = tokenizer.truncate(opening, budget, model=model)
+    budget -= opening_tokens
+
+    # 新しいメッセージから順に詰め込む
+    recent = []
+    for line, tokens in reversed(entries[1:]):
+        if tokens > budget:
+            break
+        recent.append(line)
+        budget -= tokens
+    recent.reverse()
+
+    history = opening + ELISION_MARKER + "".join(recent)
+    token_size = max_tokens - budget
+    return history, token_size, total_tokens - token_size + marker_tokens
@@ -0,0 +1,106 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+import boto3
+from collections import OrderedDict
+from botocore.exceptions import ClientError
+
+DB_MESSAGE_TABLE = os.getenv("DB_MESSAGE_TABLE")
+# 同じイベントを重複とみなす秒数
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "3600"))
+# コンテナ内で記憶するイベントの最大数
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "1024"))
+
+dynamodb = boto3.resource("dynamodb")
+
+
+# Slackのイベントから再送されても変わらないキーを生成します。
+def event_key(event):
+    channel_id = event.get("channel", "")
+    ts = event.get("ts", "")
+    # 同じメッセージに対するFAQボタンなどを区別するために本文のハッシュを加える
+    text_hash = hashlib.sha1(event.get("text", "").encode()).hexdigest()[:12]
+    return f"{channel_id}_{ts}_{text_hash}"
+
+
+# イベントを一度だけ処理するための2段階の重複排除クラスです。
+# 1段目はコンテナ内のLRU、2段目はDynamoDBの条件付き書き込みでコンテナ間の重複を排除します。
+class IdempotencyStore:
+    def __init__(self, scope, ttl=IDEMPOTENCY_TTL, size=IDEMPOTENCY_CACHE_SIZE):
+        self.scope = scope
+        self.ttl = ttl
+        self.size = size
+        self.seen = OrderedDict()
+        self.lock = threading.Lock()
+        self.table = dynamodb.Table(DB_MESSAGE_TABLE)
+
+    def _seen_locally(self, key, now):
+        with self.lock:
+            expires_at = self.seen.get(key)
+            if expires_at is None:
+                return False
+            if expires_at < now:
+                del self.seen[key]
+                return False
+            self.seen.move_to_end(key)
+            return True
+
+    def _remember(self, key, expires_at):
+        with self.lock:
+            self.seen[key] = expires_at
+            self.seen.move_to_end(key)
+            while len(self.seen) > self.size:
+                self.seen.popitem(last=False)
+
+    # 初めて処理するイベントであればTrueを返します。
+    def claim(self, key):
+        now = int(time.time())
+        if self._seen_locally(key, now):
+            logging.info(f"duplicate event ({self.scope}, local): {key}")
+            return False
+        expires_at = now + self.ttl
+        try:
+            self.table.put_item(
+                Item={
+                    "doc_id": f"event_{self.scope}_{key}",
+                    "expires_at": expires_at,
+                },
+                ConditionExpression="attribute_not_exists(doc_id) OR expires_at < :now",
+                ExpressionAttributeValues={":now": now},
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                # DynamoDBが利用できない場合はイベントを取りこぼさないように処理を続ける
+                logging.error(e)
+                self._remember(key, expires_at)
+                return True
+            logging.info(f"duplicate event ({self.scope}, shared): {key}")
+            self._remember(key, expires_at)
+            return False
+        self._remember(key, expires_at)
+        return True
+
+    # 既に受け付けたイベントであればTrueを返します。(受け付けの記録はしない)
+    def is_claimed(self, key):
+        now = int(time.time())
+        if self._seen_locally(key, now):
+            return True
+        try:
+            item = self.table.get_item(
+                Key={"doc_id": f"event_{self.scope}_{key}"}, ConsistentRead=True
+            ).get("Item")
+        except ClientError as e:
+            logging.error(e)
+            return False
+        return item is not None and int(item["expires_at"]) >= now
+
+    # 処理に失敗したイベントの受け付けを取り消し、再送で処理できるようにします。
+    def release(self, key):
+        with self.lock:
+            self.seen.pop(key, None)
+        try:
+            self.table.delete_item(Key={"doc_id": f"event_{self.scope}_{key}"})
+        except ClientError as e:
+            logging.error(e)
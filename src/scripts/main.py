@@ -1,10 +1,11 @@
 import os
 import json
+import time
 import logging
-import hashlib
 import sentry_sdk
 from datetime import datetime
 from tempfile import mkdtemp
+from concurrent.futures import ThreadPoolExecutor
 from sentry_sdk import set_user, set_tag
 from urllib.parse import unquote
 from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
@@ -15,10 +16,15 @@ from plugin import handle_file_plugin, handle_input_plugin
 from ui import generate_api_key_input_message
 from thread import handle_thread
 from store import Assistant
+from idempotency import IdempotencyStore, event_key
+from debounce import MessageDebouncer, DEBOUNCE_SECONDS
+from stages import StageGraph
 from slacklib import (
     post_message,
     update_message,
-    get_slack_file_bytes,
+    download_slack_file,
+    SLACK_MAX_FILE_BYTES,
+    SLACK_DOWNLOAD_WORKERS,
     BOT_USER_ID,
 )
 
@@ -28,6 +34,9 @@ BOT_NAME = os.getenv("BOT_NAME")
 # デバッグモード
 DEBUG = os.getenv("DEBUG", "false").lower() == "true"
 
+# 1メッセージでダウンロードするファイルの合計サイズの上限
+MAX_TOTAL_FILE_BYTES = int(os.getenv("MAX_TOTAL_FILE_BYTES", str(300 * 1024 * 1024)))
+
 logging.info(f"[Start Function] User:{BOT_USER_ID} debug: {DEBUG}")
 
 sentry_sdk.init(
@@ -43,22 +52,50 @@ sentry_sdk.init(
 set_tag("botname", BOT_NAME)
 
 
+# 1ファイルをダウンロードし、スループットを記録します。
+def download_file(file):
+    url_private = file["url_private_download"]
+    filename = datetime.now().strftime("%Y%m%d_") + unquote(file["name"])
+    file_path = os.path.join(mkdtemp(), filename)
+    start_time = time.perf_counter()
+    size = download_slack_file(url_private, file_path)
+    elapsed = time.perf_counter() - start_time
+    throughput = size / max(elapsed, 1e-6) / 1024 / 1024
+    logging.info(
+        f"upload: {filename} ({size} bytes, {elapsed:.2f}s, {throughput:.2f}MB/s)"
+    )
+    return file_path
+
+
 def handle_file_share(event):
     files = []
-    # アップロードされたファイルを取得
+    targets = []
+    total_size = 0
+    # ダウンロードする前にファイルサイズの上限を確認する
     for file in event.get("files", []):
-        url_private = file["url_private_download"]
-        filename = datetime.now().strftime("%Y%m%d_") + unquote(file["name"])
-        file_path = os.path.join(mkdtemp(), filename)
-        file_data = get_slack_file_bytes(url_private)
-        with open(file_path, "wb") as f:
-            f.write(file_data)
-        logging.info(f"upload: {filename}")
-        files.append(file_path)
+        size = file.get("size", 0)
+        if size > SLACK_MAX_FILE_BYTES:
+            logging.error(f"skip large file: {file['name']} ({size} bytes)")
+            continue
+        if total_size + size > MAX_TOTAL_FILE_BYTES:
+            logging.error(f"skip file over total limit: {file['name']} ({size} bytes)")
+            continue
+        total_size += size
+        targets.append(file)
+
+    # アップロードされたファイルを並列で取得
+    with ThreadPoolExecutor(max_workers=SLACK_DOWNLOAD_WORKERS) as executor:
+        futures = [executor.submit(download_file, file) for file in targets]
+        for file, future in zip(targets, futures):
+            try:
+                files.append(future.result())
+            except Exception as e:
+                logging.error(f"failed to download {file['name']}: {e}")
+                sentry_sdk.capture_exception(e)
     return files
 
 
-def handle_message(event):
+def handle_message(event, deadline=None):
     headers = {"Content-Type": "application/json"}
     user_id = event.get("user")
     message_text = event.get("text", "")
@@ -69,57 +106,101 @@ def handle_message(event):
     response_files = []
     upload_files = []
 
-    res = post_message(channel_id, event_ts, "Typing...")
-    process_ts = res["ts"]
-    assistant = Assistant(user_id)
+    # 互いに依存しない前処理は並列で実行する
+    def typing():
+        res = post_message(channel_id, event_ts, "Typing...")
+        return res["ts"]
+
+    def has_api_key(assistant):
+        return assistant.api_key.find("sk-") != -1
+
+    def load_config(assistant, api_key):
+        # APIキーが設定されていなければ設定を読み込まない
+        if not api_key:
+            return None
+        # プロンプトからアシスタントの設定を変更
+        assistant_config = assistant.load_assistant_config()
+        logging.info(f"assistant config: {assistant_config}")
+        return assistant_config
+
+    # APIキーが設定されていないユーザのメッセージはプラグインやダウンロードを実行しない
+    def input_plugin(process_ts, api_key):
+        if not api_key:
+            return []
+        # メッセージからファイルを抽出
+        additional_prompt, extract_files = handle_input_plugin(event, process_ts)
+        event["text"] += additional_prompt
+
+        # 抽出されたファイルをスレッドに返信する
+        if len(extract_files) > 0:
+            message = "以下のファイルが抽出されました。"
+            # 抽出されたファイルを返信する
+            post_message(channel_id, thread_ts, message, files=extract_files)
+        return extract_files
+
+    def file_share(api_key):
+        # ファイルアップロードイベント
+        if api_key and subtype == "file_share":
+            return handle_file_share(event)
+        return []
+
+    def file_plugin(process_ts, api_key, extract_files, files):
+        if not api_key:
+            return []
+        # ファイルプラグインの実行
+        return handle_file_plugin(event, extract_files + files, process_ts)[0]
+
+    graph = StageGraph(name="preprocess")
+    graph.add("typing", typing, timeout=30)
+    graph.add("assistant", lambda: Assistant(user_id), timeout=30)
+    graph.add("api_key", has_api_key, deps=["assistant"], timeout=30)
+    graph.add("config", load_config, deps=["assistant", "api_key"], timeout=120)
+    graph.add("input_plugin", input_plugin, deps=["typing", "api_key"], timeout=180)
+    graph.add("file_share", file_share, deps=["api_key"], timeout=180)
+    graph.add(
+        "file_plugin",
+        file_plugin,
+        deps=["typing", "api_key", "input_plugin", "file_share"],
+        timeout=300,
+    )
+    results = graph.run()
+    process_ts = results["typing"]
+    assistant = results["assistant"]
+    assistant_config = results["config"]
+    extract_files = results["file_plugin"]
 
     # APIキーが設定されていなければメッセージを送信する
-    if assistant.api_key.find("sk-") == -1:
+    if not results["api_key"]:
         blocks = generate_api_key_input_message()
         update_message(channel_id, process_ts, blocks=blocks)
         return
 
-    # プロンプトからアシスタントの設定を変更
-    assistant_config = assistant.load_assistant_config()
-    logging.info(f"assistant config: {assistant_config}")
-
-    # メッセージからファイルを抽出
-    additional_prompt, extract_files = handle_input_plugin(event, process_ts)
-    event["text"] += additional_prompt
-
-    # 抽出されたファイルをスレッドに返信する
-    if len(extract_files) > 0:
-        message = "以下のファイルが抽出されました。"
-        # 抽出されたファイルを返信する
-        post_message(channel_id, thread_ts, message, files=extract_files)
-
-    # ファイルアップロードイベント
-    if subtype == "file_share":
-        files = handle_file_share(event)
-        extract_files.extend(files)
-
-    # ファイルプラグインの実行
-    extract_files, event = handle_file_plugin(event, extract_files, process_ts)
     # アシスタントの処理
-    handle_thread(event, process_ts, extract_files, assistant, assistant_config)
+    handle_thread(
+        event,
+        process_ts,
+        extract_files,
+        assistant,
+        assistant_config,
+        deadline=deadline,
+    )
 
     logging.info(f"response files: {response_files}")
 
     return ("", 200, headers)
 
 
-message_cache = []
+# SNSから再送されたイベントの重複排除
+process_events = IdempotencyStore(scope="process")
 
 
 def handler(event, context):
+    # Lambdaの終了時刻 (実行中のRunを待つ時間の上限に使う)
+    deadline = time.time() + context.get_remaining_time_in_millis() / 1000
     # SNSからメッセージが再送されている場合は無視
     event = json.loads(event["Records"][0]["Sns"]["Message"])
-    message_text = json.dumps(event)
-    message_hash = hashlib.md5(message_text.encode()).hexdigest()
-    if message_hash in message_cache and len(message_text) > 0:
+    if not process_events.claim(event_key(event)):
         return "OK"
-    else:
-        message_cache.append(message_hash)
 
     with sentry_sdk.configure_scope() as scope:
         user_id = event.get("user")
@@ -127,7 +208,12 @@ def handler(event, context):
         try:
             # メッセージイベントの処理
             if event["type"] == "message":
-                handle_message(event)
+                if DEBOUNCE_SECONDS > 0:
+                    thread_ts = event.get("thread_ts", event.get("ts"))
+                    doc_id = f'{BOT_USER_ID}_run_{thread_ts.replace(".", "")}'
+                    event = MessageDebouncer(doc_id).debounce(event)
+                if event is not None:
+                    handle_message(event, deadline=deadline)
         except Exception as e:
             logging.error(e)
             sentry_sdk.capture_exception(e)
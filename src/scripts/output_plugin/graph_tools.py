@@ -5,6 +5,9 @@ import logging
 from tools import browser_open
 from tempfile import mkdtemp
 
+# mermaidの描画が完了したかどうかを判定するスクリプト
+MERMAID_READY_SCRIPT = "return document.querySelector('.mermaid svg') !== null"
+
 
 def run(text):
     """
@@ -61,7 +64,7 @@ def mermaid_to_image(mermaid_script):
         file.write(html_template)
 
     url = "file://" + os.path.abspath(html_file)
-    content = browser_open(url, png_file)
+    content = browser_open(url, png_file, ready_script=MERMAID_READY_SCRIPT)
     return png_file
 
 
@@ -3,6 +3,19 @@ import os
 from tempfile import mkdtemp
 from tools import browser_open
 
+# 読み込み完了後にJavaScriptのグラフやアニメーションの描画を待つミリ秒
+HTML_EXPORT_SETTLE_MS = int(os.getenv("HTML_EXPORT_SETTLE_MS", "2000"))
+# 描画のフレームが進んでから一定時間が経過したかどうかを判定するスクリプト
+HTML_READY_SCRIPT = f"""
+if (window.__exportReadyAt === undefined) {{
+    window.__exportReadyAt = null;
+    requestAnimationFrame(() => requestAnimationFrame(() => {{
+        window.__exportReadyAt = performance.now() + {HTML_EXPORT_SETTLE_MS};
+    }}));
+}}
+return window.__exportReadyAt !== null && performance.now() >= window.__exportReadyAt;
+"""
+
 
 # テキストからHTMLスクリプトを抽出し、PNGファイルとして保存する関数
 def run(text):
@@ -24,6 +37,6 @@ def run(text):
             # 出力PNGファイルのパスを生成
             png_file = os.path.join(mkdtemp(), "html.png")
             # ブラウザを開いてPNGファイルを生成
-            content = browser_open(url, png_file)
+            content = browser_open(url, png_file, ready_script=HTML_READY_SCRIPT)
             files.append(png_file)
     return files  # 出力ファイルリストを返す
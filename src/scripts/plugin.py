@@ -1,5 +1,6 @@
 import os
 import logging
+import threading
 import traceback
 import sentry_sdk
 from pluginbase import PluginBase
@@ -66,54 +67,94 @@ def handle_input_plugin(event, process_ts):
     return additional_prompt, extract_files
 
 
+# 拡張子からファイルプラグインを引くための一覧をコンテナごとに一度だけ作成するクラスです。
+# 拡張子ごとにプラグインのインスタンスを優先度の順に保持します。
+class FilePluginRegistry:
+    def __init__(self, source) -> None:
+        self.source = source
+        self.plugins = None
+        self.lock = threading.Lock()
+
+    # 全てのファイルプラグインを読み込みます。読み込み済みの場合は何もしません。
+    def load(self):
+        if self.plugins is not None:
+            return self.plugins
+        with self.lock:
+            if self.plugins is not None:
+                return self.plugins
+            plugins_with_priority = []
+            for plugin_name in self.source.list_plugins():
+                if plugin_name in DISABLE_PLUGINS:
+                    continue
+                try:
+                    plugin_module = self.source.load_plugin(plugin_name)
+                    # プラグインの優先度を取得（デフォルトは最低優先度）
+                    priority = getattr(plugin_module, "PRIORITY", float("inf"))
+                    plugin = plugin_module.CreatePlugin()
+                except Exception as e:
+                    sentry_sdk.capture_exception(e)
+                    logging.error(f"failed to load file plugin {plugin_name}: {e}")
+                    continue
+                plugins_with_priority.append((priority, plugin_name, plugin))
+            # 優先度に基づいてプラグインをソート
+            plugins_with_priority.sort(key=lambda entry: entry[:2])
+            logging.info(
+                f"load plugins: {[entry[:2] for entry in plugins_with_priority]}"
+            )
+            plugins = {}
+            for order, (_, plugin_name, plugin) in enumerate(plugins_with_priority):
+                for ext in plugin.target_ext:
+                    plugins.setdefault(ext, []).append((order, plugin_name, plugin))
+            self.plugins = plugins
+        return self.plugins
+
+    # ファイルの拡張子に対応するプラグインを(順番, プラグイン名, インスタンス)のリストで返します。
+    def get(self, file_path):
+        ext = os.path.splitext(file_path)[1]
+        return self.load().get(ext, [])
+
+
+file_plugin_registry = FilePluginRegistry(file_plugin_source)
+
+
 def handle_file_plugin(event, files, process_ts):
     user_id = event.get("user")
     channel_id = event.get("channel")
     event_ts = event.get("ts")
     message_text = event.get("text", "")
     response_files = []
-    for file_path in files:
-        # プラグインとその優先度を格納するリスト
-        plugins_with_priority = []
-        for plugin_name in file_plugin_source.list_plugins():
-            # プラグインの優先度を取得（デフォルトは最低優先度）
-            plugin_module = file_plugin_source.load_plugin(plugin_name)
-            priority = getattr(plugin_module, "PRIORITY", float("inf"))
-            # プラグインとその優先度をリストに追加
-            plugins_with_priority.append((priority, plugin_name))
-        # 優先度に基づいてプラグインをソート
-        plugins_with_priority.sort()
-
-        run_plugin = False
-        logging.info(f"load plugins: {plugins_with_priority}")
-        # ソートされた順序でプラグインを実行
-        for _, plugin_name in plugins_with_priority:
-            if plugin_name in DISABLE_PLUGINS:
+    reacted = False
+
+    # ファイルを対応するプラグインで処理します。
+    # プラグインが出力したファイルは、優先度がより低いプラグインで続けて処理します。
+    def dispatch(file_path, after=-1):
+        nonlocal message_text, reacted
+        plugins = [
+            entry for entry in file_plugin_registry.get(file_path) if entry[0] > after
+        ]
+        for order, plugin_name, plugin in plugins:
+            if not reacted:
+                add_reaction("arrows_counterclockwise", channel_id, event_ts)
+                reacted = True
+            logging.info(
+                f"run file plugin {plugin_name} ({file_path}) [{plugin.description}]"
+            )
+            try:
+                update_message(channel_id, process_ts, plugin.description)
+                _response_files, message_text = plugin.run(message_text, file_path)
+            except Exception as e:
+                sentry_sdk.capture_exception(e)
+                logging.error(traceback.format_exc())
+                add_reaction("dizzy_face", channel_id, event_ts)
                 continue
-            # プラグインモジュールをインポート
-            plugin_module = file_plugin_source.load_plugin(plugin_name)
-            plugin = plugin_module.CreatePlugin()
-
-            process_files = response_files + [file_path]
-            for file in process_files:
-                # ファイルの拡張子
-                ext = os.path.splitext(file)[1]
-                if ext in plugin.target_ext:
-                    if not run_plugin:
-                        add_reaction("arrows_counterclockwise", channel_id, event_ts)
-                    run_plugin = True
-                    logging.info(
-                        f"run file plugin {plugin_name} ({file}) [{plugin.description}]"
-                    )
-                    try:
-                        update_message(channel_id, process_ts, plugin.description)
-                        _response_files, message_text = plugin.run(message_text, file)
-                        response_files.extend(_response_files)
-                    except Exception as e:
-                        sentry_sdk.capture_exception(e)
-                        logging.error(traceback.format_exc())
-                        add_reaction("dizzy_face", channel_id, event_ts)
-        if not run_plugin:
+            response_files.extend(_response_files)
+            for response_file in _response_files:
+                dispatch(response_file, order)
+        return len(plugins) > 0
+
+    for file_path in files:
+        # 対応するプラグインがないファイルはそのまま返す
+        if not dispatch(file_path):
             response_files.append(file_path)
     logging.info(f"[{user_id}] file plugin extract {len(response_files)} files")
     event["text"] = message_text
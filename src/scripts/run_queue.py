@@ -0,0 +1,146 @@
+import os
+import time
+import uuid
+import logging
+import boto3
+import sentry_sdk
+from botocore.exceptions import ClientError
+
+DB_MESSAGE_TABLE = os.getenv("DB_MESSAGE_TABLE")
+# Runの実行権の有効期限 (Lambdaのタイムアウトと同じ秒数)
+RUN_LEASE_TTL = int(os.getenv("RUN_LEASE_TTL", "500"))
+# 解放した実行権を残しておく秒数
+RUN_LEASE_RETENTION = 24 * 60 * 60
+# 実行中のRunを待つ最大の秒数
+RUN_QUEUE_TIMEOUT = int(os.getenv("RUN_QUEUE_TIMEOUT", "180"))
+# 待機後にRunを実行するために残しておくLambdaの実行時間
+RUN_QUEUE_RESERVED_TIME = int(os.getenv("RUN_QUEUE_RESERVED_TIME", "240"))
+# 実行権を確認する間隔
+RUN_QUEUE_POLL_INTERVAL = float(os.getenv("RUN_QUEUE_POLL_INTERVAL", "2"))
+
+dynamodb = boto3.resource("dynamodb")
+
+
+# 実行中のRunが時間内に終わらなかった場合の例外です。
+class RunQueueTimeoutError(Exception):
+    pass
+
+
+# Lambdaの終了時刻 (UNIX時間) から、Runの実行時間を残して待機できる秒数を求めます。
+def queue_timeout(deadline=None):
+    if deadline is None:
+        return RUN_QUEUE_TIMEOUT
+    remaining_time = deadline - time.time() - RUN_QUEUE_RESERVED_TIME
+    return max(min(RUN_QUEUE_TIMEOUT, remaining_time), 0)
+
+
+# 同じスレッドのRunを1つずつ実行するための実行権 (リース) を管理するクラスです。
+# DynamoDBの条件付き書き込みで実行権を取得し、取得できなければ解放されるまで待ちます。
+class ThreadRunQueue:
+    def __init__(
+        self,
+        doc_id,
+        ttl=RUN_LEASE_TTL,
+        timeout=RUN_QUEUE_TIMEOUT,
+        poll_interval=RUN_QUEUE_POLL_INTERVAL,
+        table=None,
+    ):
+        self.doc_id = f"lease_{doc_id}"
+        self.owner = uuid.uuid4().hex
+        self.ttl = ttl
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.table = table or dynamodb.Table(DB_MESSAGE_TABLE)
+        self.queue_depth = 0
+        self.wait_time = 0
+        # 実行権を持っていない場合はTrue (解放の書き込みを省略する)
+        self.released = True
+
+    def _try_acquire(self):
+        now = int(time.time())
+        try:
+            self.table.update_item(
+                Key={"doc_id": self.doc_id},
+                UpdateExpression="SET #owner = :o, expires_at = :e",
+                ConditionExpression="attribute_not_exists(#owner) OR expires_at < :now",
+                ExpressionAttributeNames={"#owner": "owner"},
+                ExpressionAttributeValues={
+                    ":o": self.owner,
+                    ":e": now + self.ttl,
+                    ":now": now,
+                },
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+        self.released = False
+        return True
+
+    # 実行権が解放されているか、有効期限が切れているかを読み込みで確認します。
+    # 失敗した条件付き書き込みも書き込みキャパシティを消費するため、待機中はこちらで確認します。
+    def _is_free(self):
+        item = self.table.get_item(
+            Key={"doc_id": self.doc_id}, ConsistentRead=True
+        ).get("Item")
+        if item is None or "owner" not in item:
+            return True
+        return int(item["expires_at"]) < int(time.time())
+
+    # 待機中のメッセージ数を増減し、増減後の値を返します。
+    def _add_waiting(self, count):
+        response = self.table.update_item(
+            Key={"doc_id": self.doc_id},
+            UpdateExpression="ADD waiting :c",
+            ExpressionAttributeValues={":c": count},
+            ReturnValues="UPDATED_NEW",
+        )
+        return int(response["Attributes"]["waiting"])
+
+    # 実行権を取得します。実行中のRunがあれば解放されるまで待ちます。
+    # on_waitは待ち始めたときに待機中のメッセージ数を引数として呼び出されます。
+    def acquire(self, on_wait=None):
+        start_time = time.perf_counter()
+        if self._try_acquire():
+            return
+        self.queue_depth = self._add_waiting(1)
+        try:
+            if on_wait is not None:
+                on_wait(self.queue_depth)
+            while time.perf_counter() - start_time < self.timeout:
+                time.sleep(self.poll_interval)
+                if self._is_free() and self._try_acquire():
+                    return
+            raise RunQueueTimeoutError(f"{self.doc_id} is busy")
+        finally:
+            self._add_waiting(-1)
+            self.wait_time = time.perf_counter() - start_time
+            logging.info(
+                f"run queue {self.doc_id}: depth={self.queue_depth} "
+                f"wait={self.wait_time:.2f}s"
+            )
+            sentry_sdk.set_measurement("run_queue.depth", self.queue_depth)
+            sentry_sdk.set_measurement(
+                "run_queue.wait", self.wait_time * 1000, "millisecond"
+            )
+
+    # 実行権を解放します。既に解放済みの場合は何もしません。
+    def release(self):
+        if self.released:
+            return
+        self.released = True
+        try:
+            self.table.update_item(
+                Key={"doc_id": self.doc_id},
+                # 使われなくなった実行権はTTLで削除する
+                UpdateExpression="REMOVE #owner SET expires_at = :e",
+                ConditionExpression="#owner = :o",
+                ExpressionAttributeNames={"#owner": "owner"},
+                ExpressionAttributeValues={
+                    ":o": self.owner,
+                    ":e": int(time.time()) + RUN_LEASE_RETENTION,
+                },
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
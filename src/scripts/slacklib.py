@@ -2,6 +2,7 @@ import os
 import re
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 from tempfile import mkdtemp
 from slack_sdk import WebClient
@@ -15,14 +16,55 @@ slack_bot_client = WebClient(token=SLACK_BOT_TOKEN, timeout=300)
 auth_response = slack_bot_client.auth_test()
 BOT_USER_ID = auth_response["user_id"]
 
+# ファイルのダウンロードの設定
+SLACK_MAX_FILE_BYTES = int(os.getenv("SLACK_MAX_FILE_BYTES", str(200 * 1024 * 1024)))
+SLACK_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+SLACK_DOWNLOAD_TIMEOUT = 60
+SLACK_DOWNLOAD_WORKERS = int(os.getenv("SLACK_DOWNLOAD_WORKERS", "4"))
+slack_file_session = requests.Session()
+slack_file_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=SLACK_DOWNLOAD_WORKERS, pool_maxsize=SLACK_DOWNLOAD_WORKERS
+    ),
+)
+
 
 def get_user_id(user_id):
     return slack_bot_client.users_info(user=user_id)
 
 
-def get_slack_file_bytes(file_url) -> bytes:
-    r = requests.get(file_url, headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"})
-    return r.content
+# ダウンロードしたファイルがサイズの上限を超えた場合の例外です。
+class FileTooLargeError(Exception):
+    pass
+
+
+# Slackのファイルを分割して読み込みながらディスクに書き込みます。
+def download_slack_file(file_url, file_path, max_bytes=SLACK_MAX_FILE_BYTES) -> int:
+    size = 0
+    with slack_file_session.get(
+        file_url,
+        headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
+        stream=True,
+        timeout=SLACK_DOWNLOAD_TIMEOUT,
+    ) as r:
+        r.raise_for_status()
+        content_length = int(r.headers.get("Content-Length", 0))
+        if content_length > max_bytes:
+            raise FileTooLargeError(f"{content_length} bytes > {max_bytes} bytes")
+        try:
+            with open(file_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=SLACK_DOWNLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise FileTooLargeError(f"over {max_bytes} bytes")
+                    f.write(chunk)
+        except Exception:
+            # 途中までダウンロードしたファイルは削除する
+            if os.path.exists(file_path):
+                os.remove(file_path)
+            raise
+    return size
 
 
 def update_message(channel_id, message_ts, text="", blocks=[]):
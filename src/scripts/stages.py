@@ -0,0 +1,102 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# ステージのタイムアウトのデフォルト値
+DEFAULT_STAGE_TIMEOUT = 120
+
+
+# ステージが時間内に終わらなかった場合の例外です。
+class StageTimeoutError(Exception):
+    pass
+
+
+# 依存関係のある処理をスレッドプールで並列に実行するクラスです。
+# 各ステージは依存するステージの結果を引数として受け取ります。
+class StageGraph:
+    def __init__(self, name="stages", max_workers=4) -> None:
+        self.name = name
+        self.max_workers = max_workers
+        self.stages = {}
+        self.timings = {}
+
+    # ステージを追加します。依存するステージは先に追加しておく必要があります。
+    def add(self, name, func, deps=(), timeout=DEFAULT_STAGE_TIMEOUT):
+        for dep in deps:
+            if dep not in self.stages:
+                raise ValueError(f"unknown stage: {dep}")
+        self.stages[name] = {"func": func, "deps": tuple(deps), "timeout": timeout}
+
+    def _ready_stages(self, results, running):
+        return [
+            name
+            for name, stage in self.stages.items()
+            if name not in results
+            and name not in running
+            and all(dep in results for dep in stage["deps"])
+        ]
+
+    def _run_stage(self, name, args):
+        start_time = time.perf_counter()
+        try:
+            return self.stages[name]["func"](*args)
+        finally:
+            self.timings[name] = (start_time, time.perf_counter())
+
+    # 全てのステージを実行し、ステージ名と結果の辞書を返します。
+    def run(self):
+        results = {}
+        running = {}
+        self.started_at = time.perf_counter()
+        executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            while len(results) < len(self.stages):
+                for name in self._ready_stages(results, running):
+                    args = [results[dep] for dep in self.stages[name]["deps"]]
+                    future = executor.submit(self._run_stage, name, args)
+                    deadline = time.perf_counter() + self.stages[name]["timeout"]
+                    running[name] = (future, deadline)
+                now = time.perf_counter()
+                timeout = min(deadline for _, deadline in running.values()) - now
+                done, _ = wait(
+                    [future for future, _ in running.values()],
+                    timeout=max(timeout, 0),
+                    return_when=FIRST_COMPLETED,
+                )
+                for name, (future, deadline) in list(running.items()):
+                    if future in done:
+                        del running[name]
+                        # ステージで発生した例外はそのまま呼び出し元に伝える
+                        results[name] = future.result()
+                    elif deadline <= time.perf_counter():
+                        raise StageTimeoutError(f"{self.name}.{name} timed out")
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.log_timings()
+        return results
+
+    # 完了が最も遅いステージから依存関係を遡り、クリティカルパスを求めます。
+    def critical_path(self):
+        if len(self.timings) == 0:
+            return []
+        path = []
+        name = max(self.timings, key=lambda n: self.timings[n][1])
+        while name is not None:
+            path.append(name)
+            deps = [dep for dep in self.stages[name]["deps"] if dep in self.timings]
+            name = max(deps, key=lambda n: self.timings[n][1]) if deps else None
+        return path[::-1]
+
+    # ステージごとの実行時間をログに出力します。
+    def log_timings(self):
+        breakdown = ", ".join(
+            f"{name}={end - start:.2f}s (+{start - self.started_at:.2f}s)"
+            for name, (start, end) in sorted(
+                self.timings.items(), key=lambda item: item[1][0]
+            )
+        )
+        total = time.perf_counter() - self.started_at
+        logging.info(
+            f"[{self.name}] total={total:.2f}s {breakdown} "
+            f"critical_path={' -> '.join(self.critical_path())}"
+        )
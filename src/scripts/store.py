@@ -1,12 +1,16 @@
 import os
-import yaml
 import json
+import time
 import logging
+import threading
 import boto3
-from tempfile import mkdtemp
+from botocore.exceptions import ClientError
+from decimal import Decimal
+from datetime import datetime
 from slacklib import get_user_id
-from ai import AssistantAPIClient
-from tools import browser_open
+from ai import AssistantAPIClient, calculate_cost
+from url_cache import get_url_file
+from assistant_config import assistant_registry
 
 # DynamoDB Client
 dynamodb = boto3.resource("dynamodb")
@@ -19,6 +23,51 @@ ASSISTANT_ID = os.getenv("ASSISTANT_ID", "none")
 TOPIC_ARN = os.getenv("AWS_SNS_TOPIC_ARN")
 DB_USERS_TABLE = os.getenv("DB_USERS_TABLE")
 DB_MESSAGE_TABLE = os.getenv("DB_MESSAGE_TABLE")
+# ユーザ情報をコンテナ内でキャッシュする秒数
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "30"))
+# コスト台帳を保持する日数
+COST_LEDGER_RETENTION_DAYS = 90
+# usage APIとの突き合わせを行う間隔 (0の場合は行わない)
+COST_RECONCILE_INTERVAL = int(os.getenv("COST_RECONCILE_INTERVAL", "0"))
+
+# user_id -> (有効期限, DynamoDBのItem)
+_user_cache = {}
+# APIキー -> AssistantAPIClient
+_client_cache = {}
+_cache_lock = threading.Lock()
+
+
+# ユーザ情報を取得します。有効期限内であればDynamoDBを参照しません。
+def get_user_item(table, user_id):
+    now = time.time()
+    cached = _user_cache.get(user_id)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+    response = table.get_item(Key={"user_id": user_id})
+    item = response.get("Item")
+    # 未登録のユーザは別のLambda関数で登録されるため、登録直後に反映されるようにキャッシュしない
+    if item is not None:
+        with _cache_lock:
+            _user_cache[user_id] = (now + USER_CACHE_TTL, item)
+    return item
+
+
+# ユーザ情報のキャッシュを破棄します。
+def invalidate_user_item(user_id):
+    with _cache_lock:
+        _user_cache.pop(user_id, None)
+
+
+# APIキーごとにAssistantAPIClientを使い回します。
+def get_assistant_client(api_key):
+    client = _client_cache.get(api_key)
+    if client is None:
+        with _cache_lock:
+            client = _client_cache.get(api_key)
+            if client is None:
+                client = AssistantAPIClient(api_key=api_key)
+                _client_cache[api_key] = client
+    return client
 
 
 class Assistant:
@@ -34,24 +83,22 @@ class Assistant:
 
     def _get_assistant(self):
         # DynamoDBからAssistant IDを取得
-        response = self.table.get_item(Key={"user_id": self.user_id})
-        if "Item" in response:
+        item = get_user_item(self.table, self.user_id)
+        if item is not None:
             # ドキュメントIDが存在する場合はAssistant IDを取得する
-            self.assistant_id = response["Item"].get("assistant_id")
-            self.level = int(response["Item"].get("level", 0))
-            self.api_key = response["Item"].get("api_key", self.api_key)
-            self.assistant_name = response["Item"].get(
-                "assistant_name", self.assistant_name
-            )
+            self.assistant_id = item.get("assistant_id")
+            self.level = int(item.get("level", 0))
+            self.api_key = item.get("api_key", self.api_key)
+            self.assistant_name = item.get("assistant_name", self.assistant_name)
             if len(self.api_key) > 5:
-                self.client = AssistantAPIClient(api_key=self.api_key)
+                self.client = get_assistant_client(self.api_key)
             logging.info(f"exists assistant: {self.assistant_id}")
 
     def create_assistant(self, api_key):
         user_info = get_user_id(self.user_id)
         username = user_info["user"]["real_name"]
         self.api_key = api_key
-        self.client = AssistantAPIClient(api_key=api_key)
+        self.client = get_assistant_client(api_key)
         # 新しいアシスタントを作成する
         self.assistant_id = self.client.create_assistant(f"{username}'s Assistant")
         logging.info(f"new assistant: {self.assistant_id}")
@@ -63,6 +110,7 @@ class Assistant:
                 "api_key": self.api_key,
             }
         )
+        invalidate_user_item(self.user_id)
 
     def get_client(self):
         return self.client
@@ -90,52 +138,29 @@ class Assistant:
             ExpressionAttributeNames={"#lvl": "level"},
             ExpressionAttributeValues={":l": level},
         )
+        invalidate_user_item(self.user_id)
 
     def update_assistant_name(self, assistant_name):
+        self.assistant_name = assistant_name
         table = dynamodb.Table(DB_USERS_TABLE)
         table.update_item(
             Key={"user_id": self.user_id},
             UpdateExpression="set assistant_name = :n",
             ExpressionAttributeValues={":n": assistant_name},
         )
+        invalidate_user_item(self.user_id)
 
     def load_assistant_config(self):
-        assistant_file = "/function/data/assistant.yml"
-        # モデルを初期化
-        assistant_config = {
-            "model": "",
-            "faq": [],
-            "tools": [],
-            "files": [],
-            "instructions": "あなたはユーザに質問に回答するアシスタントです",
-            "additional_instructions": "",
-        }
-        # アシスタントファイルを開き、データを読み込む
-        with open(assistant_file, "r") as f:
-            assistant_data = yaml.safe_load(f)
-            assistant = assistant_data[self.assistant_name]
-            instructions = assistant.get("instructions")
-            assistant_config["model"] = assistant.get("model", "")
-            assistant_config["faq"] = assistant.get("faq", [])
-            assistant_config["tools"].extend(assistant.get("tools", []))
-            assistant_config["instructions"] = assistant_config.get(
-                "instructions", instructions
-            )
-            # ファイルを処理
-            for file in assistant.get("files", []):
-                filename = f"/function/data/{file}"
-                if os.path.exists(filename):
-                    assistant_config["files"].append(filename)
-            # URLを処理
-            for u in assistant.get("urls", []):
-                url = u["url"]
-                file = u["file"]
-                title, content = browser_open(url)
-                filename = os.path.join(mkdtemp(), file)
-                with open(filename, "w") as f:
-                    f.write(content)
-                assistant_config["files"].append(filename)
-        # モデルを返す
+        # 事前に組み立てた設定を取得し、メッセージごとの値だけを追加する
+        assistant_config = dict(assistant_registry.get(self.assistant_name))
+        files = list(assistant_config["files"])
+        # URLを処理
+        for u in assistant_config["urls"]:
+            url = u["url"]
+            file = u["file"]
+            # キャッシュにない場合のみブラウザで開く
+            files.append(get_url_file(url, file))
+        assistant_config["files"] = tuple(files)
         return assistant_config
 
 
@@ -150,10 +175,79 @@ class ThreadStore:
             return doc["Item"]
         return None
 
-    def update_thread_info(self, item):
-        item["doc_id"] = self.doc_id
+    # スレッドの状態を更新します。メッセージ数などのカウンタを残すため指定された属性のみ書き換えます。
+    # tokensを指定した場合は同じ書き込みで質問のメッセージ数とトークン数をカウンタに加算します。
+    def update_thread_info(self, item, tokens=None):
+        table = dynamodb.Table(DB_MESSAGE_TABLE)
+        item = dict(item)
+        adds = {}
+        if tokens is not None:
+            adds["total_tokens"] = tokens
+            if "message_count" in item:
+                # カウンタの初期値を設定する場合は同じ属性にADDできないため加算済みの値にする
+                item["message_count"] += 1
+            else:
+                adds["message_count"] = 1
+        names = {f"#k{i}": key for i, key in enumerate(item)}
+        values = {f":v{i}": value for i, value in enumerate(item.values())}
+        update_expression = "SET " + ", ".join(
+            f"#k{i} = :v{i}" for i in range(len(item))
+        )
+        if len(adds) > 0:
+            names.update({f"#a{i}": key for i, key in enumerate(adds)})
+            values.update({f":a{i}": value for i, value in enumerate(adds.values())})
+            update_expression += " ADD " + ", ".join(
+                f"#a{i} :a{i}" for i in range(len(adds))
+            )
+        table.update_item(
+            Key={"doc_id": self.doc_id},
+            UpdateExpression=update_expression,
+            ExpressionAttributeNames=names,
+            ExpressionAttributeValues=values,
+        )
+
+    # 要約したOpenAI Threadに切り替えます。
+    # 要約中に新しいメッセージが追加された場合は切り替えずにFalseを返します。
+    def replace_thread(self, doc, thread_id, message_count, total_tokens):
+        table = dynamodb.Table(DB_MESSAGE_TABLE)
+        try:
+            table.update_item(
+                Key={"doc_id": self.doc_id},
+                UpdateExpression=(
+                    "SET thread_id = :new, message_count = :n, total_tokens = :t "
+                    "ADD compactions :one"
+                ),
+                ConditionExpression="thread_id = :old AND message_count = :count",
+                ExpressionAttributeValues={
+                    ":new": thread_id,
+                    ":n": message_count,
+                    ":t": total_tokens,
+                    ":one": 1,
+                    ":old": doc["thread_id"],
+                    ":count": doc["message_count"],
+                },
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+        return True
+
+    # 完了したRunの回答をメッセージ数とトークン数に加算します。
+    def add_run(self, prompt_tokens, completion_tokens):
         table = dynamodb.Table(DB_MESSAGE_TABLE)
-        table.put_item(Item=item)
+        table.update_item(
+            Key={"doc_id": self.doc_id},
+            UpdateExpression=(
+                "ADD message_count :one, total_tokens :t, runs :one "
+                "SET last_prompt_tokens = :p"
+            ),
+            ExpressionAttributeValues={
+                ":one": 1,
+                ":t": completion_tokens,
+                ":p": prompt_tokens,
+            },
+        )
 
     def update_run_id(self, run_id):
         table = dynamodb.Table(DB_MESSAGE_TABLE)
@@ -164,6 +258,100 @@ class ThreadStore:
         )
 
 
+# ユーザごと・日ごとのコストを集計する台帳です。
+# 完了したRunのトークン使用量を加算するため、表示時にusage APIを呼び出す必要がありません。
+class CostLedger:
+    def __init__(self, user_id, date=None):
+        self.user_id = user_id
+        self.date = date or datetime.now().strftime("%Y-%m-%d")
+        self.doc_id = f"cost_{user_id}_{self.date.replace('-', '')}"
+        self.table = dynamodb.Table(DB_MESSAGE_TABLE)
+
+    # Runのトークン使用量を加算します。
+    def add_usage(self, model, prompt_tokens, completion_tokens):
+        cost = calculate_cost(model, prompt_tokens, completion_tokens)
+        expires_at = int(time.time()) + COST_LEDGER_RETENTION_DAYS * 24 * 60 * 60
+        self.table.update_item(
+            Key={"doc_id": self.doc_id},
+            UpdateExpression=(
+                "ADD cost :c, prompt_tokens :p, completion_tokens :o, runs :one "
+                "SET expires_at = if_not_exists(expires_at, :e)"
+            ),
+            ExpressionAttributeValues={
+                ":c": Decimal(str(round(cost, 8))),
+                ":p": prompt_tokens,
+                ":o": completion_tokens,
+                ":one": 1,
+                ":e": expires_at,
+            },
+        )
+        logging.info(f"cost ledger {self.doc_id}: +{cost} USD ({model})")
+
+    def get_item(self):
+        response = self.table.get_item(Key={"doc_id": self.doc_id})
+        return response.get("Item", {})
+
+    # 本日のユーザのコストと、usage APIで集計したAPIキー全体のコストを取得します。
+    # APIキー全体のコストを集計していない場合はNoneを返します。
+    def get_costs(self):
+        item = self.get_item()
+        if COST_RECONCILE_INTERVAL > 0:
+            reconciled_at = int(item.get("reconciled_at", 0))
+            if time.time() - reconciled_at > COST_RECONCILE_INTERVAL:
+                self.start_reconcile()
+        account_cost = item.get("account_cost")
+        if account_cost is not None:
+            account_cost = float(account_cost)
+        return float(item.get("cost", 0)), account_cost
+
+    # usage APIの集計結果を記録します。
+    # usage APIはAPIキー全体の集計のため、同じAPIキーを使う他のユーザの分を含まないようにcostとは別に保存します。
+    def reconcile(self, client):
+        total_cost = client.get_usage(self.date)
+        if total_cost <= 0:
+            return
+        self.table.update_item(
+            Key={"doc_id": self.doc_id},
+            UpdateExpression="SET account_cost = :c",
+            ExpressionAttributeValues={":c": Decimal(str(round(total_cost, 8)))},
+        )
+        logging.info(f"cost ledger {self.doc_id}: account total {total_cost} USD")
+
+    # 突き合わせを行った時刻を記録します。usage APIの結果に関わらず次の突き合わせまで間隔を空けるため、
+    # 他のコンテナが既に記録している場合はFalseを返します。
+    def claim_reconcile(self):
+        now = int(time.time())
+        try:
+            self.table.update_item(
+                Key={"doc_id": self.doc_id},
+                UpdateExpression=(
+                    "SET reconciled_at = :t, expires_at = if_not_exists(expires_at, :e)"
+                ),
+                ConditionExpression="attribute_not_exists(reconciled_at) OR reconciled_at < :limit",
+                ExpressionAttributeValues={
+                    ":t": now,
+                    ":limit": now - COST_RECONCILE_INTERVAL,
+                    ":e": now + COST_LEDGER_RETENTION_DAYS * 24 * 60 * 60,
+                },
+            )
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+                raise
+            return False
+        return True
+
+    # バックグラウンドでusage APIとの突き合わせを行います。
+    def start_reconcile(self):
+        item = get_user_item(dynamodb.Table(DB_USERS_TABLE), self.user_id)
+        if item is None or len(item.get("api_key", "")) <= 5:
+            return
+        if not self.claim_reconcile():
+            return
+        client = get_assistant_client(item["api_key"])
+        thread = threading.Thread(target=self.reconcile, args=(client,), daemon=True)
+        thread.start()
+
+
 def publish_event(event):
     # イベントをSNSトピックに送信
     event_data = json.dumps({"default": json.dumps(event)})
@@ -3,16 +3,20 @@ import sys
 import time
 import json
 import logging
+import threading
 import traceback
 import sentry_sdk
 from tempfile import mkdtemp
-from datetime import datetime
-from ai import HEAVY_MODEL, BASE_MODEL
+from ai import HEAVY_MODEL, BASE_MODEL, ASSISTANT_RUN_MODE
 from tools import truncate_token_size
 from ux import assistant_instructor, MAX_LEVEL
-from ui import generate_completion_block, generate_faq_block
+from ui import generate_completion_block
 from callback import StepCallback, MessageCallback
-from store import ThreadStore
+from store import ThreadStore, CostLedger
+from history import pack_history, HISTORY_MAX_TOKENS
+from stages import StageGraph
+from compaction import needs_compaction, compact_thread
+from run_queue import ThreadRunQueue, RunQueueTimeoutError, queue_timeout
 from slacklib import (
     get_thread_messages,
     add_reaction,
@@ -28,18 +32,19 @@ TEST_USER = os.getenv("TEST_USER")
 
 
 class ThreadHandler:
-    def __init__(self, prompt, files, channel_id):
+    def __init__(self, prompt, files, channel_id, model=None):
         self.prompt = prompt
+        self.model = model
         self.thread_id = None
         self.truncated_token_size = 0
         self.token_size = 0
         self.thread_len = 0
+        self.legacy_thread = False
         self.files = files[:]
         self.channel_id = channel_id
 
-    def new_thread(self, client, thread_messages):
+    def new_thread(self, thread_messages, canvas_content, thread):
         # canvasがある場合はファイルに書き出してfilesに追加
-        canvas_content = get_canvas_content(self.channel_id)
         if len(canvas_content) > 10:
             canvas_file = os.path.join(mkdtemp(), "canvas.md")
             with open(canvas_file, "w") as f:
@@ -48,55 +53,82 @@ class ThreadHandler:
         thread_len = 0
         # 12kトークンに切り捨て
         self.prompt, _token_size, _truncated_token_size = truncate_token_size(
-            self.prompt, max_tokens=12000
+            self.prompt, max_tokens=12000, model=self.model
         )
         self.truncated_token_size = _truncated_token_size
         self.token_size = _token_size
         if len(thread_messages) > 1:
-            # スレッド内の全メッセージを取得
-            messages = ""
-            thread_messages.pop(0)
-            for msg in thread_messages:
-                # 各メッセージのユーザーIDとテキストを出力
-                message_user_id = msg.get("user")
-                # Botユーザの発言は無視する
-                if message_user_id == BOT_USER_ID:
-                    continue
-                message_text = msg.get("text")
-                if len(message_text) == 0:
-                    continue
-                messages += f"* <@{message_user_id}>: {message_text}\n"
-                thread_len += 1
-            # スレッドのメッセージ: 8kトークンに切り捨て
-            messages, _token_size, _truncated_token_size = truncate_token_size(
-                messages, max_tokens=8000
+            # Botユーザの発言と空のメッセージは無視する
+            history_messages = [
+                msg
+                for msg in thread_messages
+                if msg.get("user") != BOT_USER_ID and len(msg.get("text", "")) > 0
+            ]
+            thread_len = len(history_messages)
+            # スレッドのメッセージ: 最初のメッセージと新しいメッセージを優先して8kトークンに収める
+            messages, _token_size, _truncated_token_size = pack_history(
+                history_messages, max_tokens=HISTORY_MAX_TOKENS, model=self.model
             )
             self.truncated_token_size += _truncated_token_size
             self.token_size += _token_size
             if len(messages) > 0:
                 self.prompt = f"# 指示\n{self.prompt}\n\n# チャット履歴\n{messages}\n"
         self.thread_len = thread_len
-        # Thread IDがなければ生成してDynamoDBに格納
-        thread = client.create_thread()
+        # 事前に生成したThread IDをDynamoDBに格納する
         self.thread_id = thread.id
         logging.info(f"create new thread {self.thread_id}")
 
     def exists_thread(self, client, doc, max_tokens=31000):
         # ドキュメントIDが存在する場合はOpenAI Thread IDを取得する
         self.thread_id = doc.get("thread_id")
-        self.thread_len = len(client.get_ai_thread_messages(self.thread_id))
+        if "message_count" in doc:
+            self.thread_len = int(doc["message_count"])
+        else:
+            # カウンタがない古いスレッドのみメッセージを数える
+            self.thread_len = len(client.get_ai_thread_messages(self.thread_id))
+            self.legacy_thread = True
         self.files.extend(doc.get("files", []))
 
         # 32Kトークンまで切り捨てする
         self.prompt, _token_size, _truncated_token_size = truncate_token_size(
-            self.prompt, max_tokens=max_tokens
+            self.prompt, max_tokens=max_tokens, model=self.model
         )
         self.truncated_token_size = _truncated_token_size
         self.token_size = _token_size
         logging.info(f"exists thread {self.thread_id}")
 
 
-def handle_thread(event, process_ts, files, assistant, assistant_config):
+# 新しいスレッドの開始に必要な情報を並列で取得します。
+# スレッドのメッセージ、canvas、OpenAI Threadの作成は互いに依存しないため同時に実行します。
+def prefetch_new_thread(client, channel_id, thread_ts):
+    graph = StageGraph(name="new_thread", max_workers=3)
+    graph.add(
+        "thread_messages",
+        lambda: get_thread_messages(channel_id, thread_ts),
+        timeout=60,
+    )
+    graph.add("canvas", lambda: get_canvas_content(channel_id), timeout=60)
+    graph.add("create_thread", client.create_thread, timeout=60)
+    results = graph.run()
+    return results["thread_messages"], results["canvas"], results["create_thread"]
+
+
+# 回答後のスレッドが長くなっていれば要約して新しいスレッドに切り替えます。
+# 切り替え前のスレッドに次の質問が追加されないように、終わってから実行権を解放します。
+def compact_if_needed(client, thread_store, run_queue):
+    try:
+        doc = thread_store.get_thread_info()
+        if doc is not None and needs_compaction(doc):
+            compact_thread(client, thread_store, doc)
+    except Exception as e:
+        sentry_sdk.capture_exception(e)
+        logging.exception(e)
+    finally:
+        run_queue.release()
+
+
+# deadlineはLambdaの終了時刻 (UNIX時間) で、実行中のRunを待つ時間の上限に使います。
+def handle_thread(event, process_ts, files, assistant, assistant_config, deadline=None):
     client = assistant.client
     user_id = event.get("user")
     message_text = event.get("text", "")
@@ -114,63 +146,92 @@ def handle_thread(event, process_ts, files, assistant, assistant_config):
     debug = True if user_id == TEST_USER else False
 
     prompt = message_text.replace(f"<@{BOT_USER_ID}>", "").strip()
-    th = ThreadHandler(prompt, files, channel_id)
+    th = ThreadHandler(prompt, files, channel_id, model=model_name)
+    doc_id = f'{BOT_USER_ID}_run_{thread_ts.replace(".", "")}'
+    run_queue = ThreadRunQueue(doc_id, timeout=queue_timeout(deadline))
     try:
+        # 同じスレッドで実行中のRunがあれば終わるまで待つ
+        def on_wait(queue_depth):
+            message = f"前の質問の回答を待っています。(待機中: {queue_depth}件)"
+            update_message(channel_id, process_ts, text=message)
+
+        try:
+            run_queue.acquire(on_wait=on_wait)
+        except RunQueueTimeoutError as e:
+            logging.warning(e)
+            message = "前の質問の回答を生成中のため、この質問に回答できませんでした。回答が終わってからもう一度質問してください。"
+            update_message(channel_id, process_ts, text=message)
+            return
         # DynamoDBからOpenAI Threadを取得
-        doc_id = f'{BOT_USER_ID}_run_{thread_ts.replace(".", "")}'
         thread_store = ThreadStore(doc_id=doc_id)
         doc = thread_store.get_thread_info()
-        if doc is not None:
+        # OpenAI Threadが作成されていない場合は新しいスレッドとして扱う
+        if doc is not None and doc.get("thread_id") is not None:
             th.exists_thread(client, doc)
         else:
-            thread_messages = get_thread_messages(channel_id, thread_ts)
-            th.new_thread(client, thread_messages)
+            th.new_thread(*prefetch_new_thread(client, channel_id, thread_ts))
         # 過去のファイル履歴からツールを復元する
         file_history.extend(th.files)
-        # アシスタントを更新する
-        assistant_config["tools"] = client.update_assistant_tools(
-            file_history, tools=assistant_config["tools"]
+        # アシスタントを更新する (共有の設定は書き換えない)
+        tools = client.update_assistant_tools(
+            file_history, tools=list(assistant_config["tools"])
         )
         additional_instructions = assistant_config.get("additional_instructions", "")
         logging.info(f"update assistant config: {assistant_config}")
-        client.update_assistant(
-            assistant.get_assistant_id(),
-            model=model_name,
-            instructions=assistant_config["instructions"],
-            tools=assistant_config["tools"],
-        )
+        run_overrides = None
+        if ASSISTANT_RUN_MODE == "override":
+            # 共有のアシスタントは変更せずにRun単位で設定を指定する
+            run_overrides = {
+                "model": model_name,
+                "instructions": assistant_config["instructions"],
+                "tools": tools,
+            }
+        else:
+            client.update_assistant(
+                assistant.get_assistant_id(),
+                model=model_name,
+                instructions=assistant_config["instructions"],
+                tools=tools,
+            )
         try:
             if not debug:
                 # メッセージを作成する
                 client.create_message(th.thread_id, th.prompt, files)
         except Exception as e:
             logging.exception(e)
-            # 連続で質問されている場合は失敗するので処理を終了させる
             message = f"回答の生成でエラーが発生しました。{e}"
             post_message(channel_id, thread_ts, text=message)
             return
 
         # スレッドの状態を更新する
-        thread_store.update_thread_info(
-            item={
-                "thread_id": th.thread_id,
-                "run_id": "",
-                "files": file_history,
-                "updated_at": int(time.time()),
-            },
-        )
+        thread_info = {
+            "thread_id": th.thread_id,
+            "run_id": "",
+            "files": file_history,
+            "updated_at": int(time.time()),
+        }
+        if th.legacy_thread:
+            # 数えたメッセージ数をカウンタの初期値にする
+            thread_info["message_count"] = th.thread_len
+        # 質問のメッセージ数とトークン数も同じ書き込みで加算する
+        tokens = None if debug else th.token_size
+        thread_store.update_thread_info(item=thread_info, tokens=tokens)
         # 事前にメッセージを送信
-        functions = [
-            f"`{tool['function']['name']}`"
-            for tool in assistant_config["tools"]
-            if tool["type"] == "function"
-        ]
+        functions = [f"`{name}`" for name in assistant_config["function_names"]]
         cost_1k_token = MODEL_COST_PER_1K_TOKENS.get(model_name, 0.01)
         cost_completion_1k_token = MODEL_COST_PER_1K_TOKENS.get(
             f"{model_name}-completion", 0.03
         )
         # コストやトークン使用量を計算
-        total_cost_today = client.get_usage(datetime.now().strftime("%Y-%m-%d"))
+        cost_ledger = CostLedger(user_id)
+        total_cost_today, account_cost_today = cost_ledger.get_costs()
+        total_cost_today = round(total_cost_today, 8)
+        # usage APIで集計したAPIキー全体のコスト (同じAPIキーを使う他のユーザの分を含む)
+        account_cost_message = ""
+        if account_cost_today is not None:
+            account_cost_message = (
+                f"本日のAPIキー全体のコスト: {round(account_cost_today, 8)} USD\n"
+            )
         pre_message = (
             f"`{model_name}`が回答を生成中です。\n"
             "```\n"
@@ -178,6 +239,7 @@ def handle_thread(event, process_ts, files, assistant, assistant_config):
             f"入力トークンの合計: {th.token_size}, 切り捨てられたトークンの合計: {th.truncated_token_size}\n"
             f"予測コスト: {round((th.token_size/1024)*cost_1k_token+(th.token_size/1024)*cost_completion_1k_token, 8)} USD\n"
             f"本日の合計コスト: {total_cost_today} USD\n"
+            f"{account_cost_message}"
             "```\n"
             f"有効なアクション: {', '.join(functions)}\n"
         )
@@ -197,13 +259,19 @@ def handle_thread(event, process_ts, files, assistant, assistant_config):
             message_callback,
             step_callback,
             additional_instructions,
+            cost_ledger=cost_ledger,
+            overrides=run_overrides,
+        )
+        # 要約はユーザへの回答と並行して実行し、終わり次第次の質問のRunを開始できるようにする
+        compaction = threading.Thread(
+            target=compact_if_needed, args=(client, thread_store, run_queue)
         )
+        compaction.start()
         time.sleep(1)
         # よくある質問を送信
-        faq = assistant_config["faq"]
-        if len(faq) > 0:
-            blocks = generate_faq_block(faq)
-            post_message(channel_id, thread_ts, blocks=blocks)
+        faq_blocks = assistant_config["faq_blocks"]
+        if len(faq_blocks) > 0:
+            post_message(channel_id, thread_ts, blocks=list(faq_blocks))
         # ユーザレベルを上げる
         next_level = assistant_instructor(
             channel_id,
@@ -215,7 +283,11 @@ def handle_thread(event, process_ts, files, assistant, assistant_config):
         )
         assistant.update_level(next_level)
         delete_message(channel_id, process_ts)
+        compaction.join()
     except Exception as e:
         sentry_sdk.capture_exception(e)
         logging.error(traceback.format_exc())
         post_message(channel_id, thread_ts, text=traceback.format_exc(), files=[])
+    finally:
+        # compact_if_neededで解放済みの場合は何もしない
+        run_queue.release()
@@ -0,0 +1,94 @@
+import os
+import threading
+import tiktoken
+
+# トークン数の計算に使用するデフォルトのモデル
+DEFAULT_TOKEN_MODEL = os.getenv("DEFAULT_TOKEN_MODEL", "gpt-4")
+# モデル名からエンコーディングを判別できない場合のエンコーディング
+FALLBACK_ENCODING = "cl100k_base"
+
+# モデルごとのエンコーダ (コンテナ内で使い回す)
+_encoders = {}
+_encoders_lock = threading.Lock()
+
+
+# モデル名からエンコーダを取得します。エンコーダはモデルごとに一度だけ生成します。
+def get_encoder(model=None):
+    model = model or DEFAULT_TOKEN_MODEL
+    encoder = _encoders.get(model)
+    if encoder is not None:
+        return encoder
+    with _encoders_lock:
+        encoder = _encoders.get(model)
+        if encoder is None:
+            try:
+                encoder = tiktoken.encoding_for_model(model)
+            except KeyError:
+                encoder = tiktoken.get_encoding(FALLBACK_ENCODING)
+            _encoders[model] = encoder
+    return encoder
+
+
+# テキストをトークン列に変換します。
+def encode(text, model=None):
+    return get_encoder(model).encode(text, allowed_special="all")
+
+
+# テキストを一度だけエンコードし、切り捨て後のテキスト・残ったトークン数・切り捨てたトークン数を返します。
+def truncate(text, max_tokens, model=None):
+    encoder = get_encoder(model)
+    tokens = encoder.encode(text, allowed_special="all")
+    if len(tokens) <= max_tokens:
+        return text, len(tokens), 0
+    kept_tokens = tokens[:max_tokens]
+    return encoder.decode(kept_tokens), len(kept_tokens), len(tokens) - len(kept_tokens)
+
+
+# テキストのトークン数を計算します。
+def count(text, model=None):
+    return len(encode(text, model))
+
+
+# ストリーミングで追加されるテキストのトークン数を逐次計算するクラスです。
+# 末尾の不安定な部分だけを再エンコードし、確定したトークン数は累計として保持します。
+class TokenCounter:
+    def __init__(self, model=None, tail_tokens=32, commit_tokens=256) -> None:
+        self.encoder = get_encoder(model)
+        # 再エンコードの対象として残すトークン数
+        self.tail_tokens = tail_tokens
+        # 末尾がこのトークン数を超えたら確定させる
+        self.commit_tokens = commit_tokens
+        self.reset()
+
+    # カウンターを初期化します。
+    def reset(self, text="") -> None:
+        self.stable_tokens = 0
+        self.tail = ""
+        self.total = 0
+        if text:
+            self.add(text)
+
+    # テキストを追加し、現在のトークン数の合計を返します。
+    def add(self, text) -> int:
+        self.tail += text
+        tokens = self.encoder.encode(self.tail, allowed_special="all")
+        self.total = self.stable_tokens + len(tokens)
+        if len(tokens) > self.commit_tokens:
+            self._commit(tokens)
+        return self.total
+
+    # 末尾のトークンを残して確定させます。
+    def _commit(self, tokens):
+        n = len(tokens) - self.tail_tokens
+        while n > 0:
+            # マルチバイト文字の途中で区切らないようにする
+            try:
+                prefix = self.encoder.decode_bytes(tokens[:n]).decode("utf-8")
+            except UnicodeDecodeError:
+                n -= 1
+                continue
+            if not self.tail.startswith(prefix):
+                return
+            self.stable_tokens += n
+            self.tail = self.tail[len(prefix) :]
+            return
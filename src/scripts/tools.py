@@ -1,86 +1,124 @@
 import os
-import tiktoken
 import logging
 import time
 import re
+import requests
 from bs4 import BeautifulSoup
-from selenium import webdriver
+from bs4.dammit import UnicodeDammit
+import tokenizer
+from browser import browser_pool, wait_until_ready
 
+# HTTPで取得したページを有効とみなす最小文字数
+HTTP_FETCH_MIN_CHARS = int(os.getenv("HTTP_FETCH_MIN_CHARS", "200"))
+HTTP_FETCH_TIMEOUT = 10
+# JavaScriptで描画されるページの目印
+JS_ONLY_HTML_MARKERS = (
+    '<div id="root"></div>',
+    '<div id="app"></div>',
+    '<div id="__next"></div>',
+)
+JS_ONLY_TEXT_MARKERS = (
+    "enable javascript",
+    "javascript is disabled",
+    "javascript is required",
+    "javascriptを有効",
+)
 
-def truncate_strings(text, max_tokens):
-    enc = tiktoken.encoding_for_model("gpt-4")
-    encode_strings = enc.encode(text, allowed_special="all")
-    encode_strings = encode_strings[:max_tokens]
-    return enc.decode(encode_strings)
+http_session = requests.Session()
+http_session.headers.update({"User-Agent": "Mozilla/5.0 (compatible; slack-copilot)"})
 
 
-def calculate_token_size(text):
+def truncate_strings(text, max_tokens, model=None):
+    truncated_text, _, _ = tokenizer.truncate(text, max_tokens, model=model)
+    return truncated_text
+
+
+def calculate_token_size(text, model=None):
     # TikTokのAPIやライブラリを使用して実際のトークンサイズを計算
-    encoding = tiktoken.encoding_for_model("gpt-4")
-    return len(encoding.encode(text, allowed_special="all"))
+    return tokenizer.count(text, model=model)
+
+
+def truncate_token_size(text, max_tokens, model=None):
+    # 一度のエンコードで切り捨て後のテキストとトークン数を求める
+    return tokenizer.truncate(text, max_tokens, model=model)
 
 
-def truncate_token_size(text, max_tokens):
-    origin_token_size = calculate_token_size(text)
-    truncated_text = truncate_strings(text, max_tokens)
-    token_size = calculate_token_size(truncated_text)
-    truncated_token_size = origin_token_size - token_size
-    return truncated_text, token_size, truncated_token_size
+# HTMLからscriptやstyleを除いたタイトルと本文を取り出します。
+def extract_page_text(page_source):
+    soup = BeautifulSoup(page_source, "html.parser")
+    # scriptやstyle及びその他タグの除去
+    for s in soup(["script", "style"]):
+        s.decompose()
+    title = soup.title.string if soup.title else "タイトルなし"
+    content = soup.get_text()
+    content = re.sub(r"\n+", "\n", content)
+    return title, content
+
 
+# HTTPで取得したページがJavaScriptなしで読める内容かどうかを判定します。
+def is_meaningful_page(page_source, content):
+    if len(content.strip()) < HTTP_FETCH_MIN_CHARS:
+        return False
+    lower_source = page_source.lower()
+    lower_content = content.lower()
+    if any(marker in lower_source for marker in JS_ONLY_HTML_MARKERS):
+        return False
+    return not any(marker in lower_content for marker in JS_ONLY_TEXT_MARKERS)
+
+
+# ブラウザを使わずにHTTPでページを取得します。読めない場合はNoneを返します。
+def http_open(url):
+    try:
+        response = http_session.get(url, timeout=HTTP_FETCH_TIMEOUT)
+        response.raise_for_status()
+    except requests.RequestException as e:
+        logging.info(f"http fetch failed {url}: {e}")
+        return None
+    content_type = response.headers.get("Content-Type", "")
+    if "html" not in content_type:
+        return None
+    if "charset" in content_type.lower():
+        page_source = response.text
+    else:
+        # ヘッダに文字コードがない場合はISO-8859-1にせず、<meta charset>から判定する
+        page_source = UnicodeDammit(response.content, is_html=True).unicode_markup
+    title, content = extract_page_text(page_source)
+    if not is_meaningful_page(page_source, content):
+        return None
+    return title, content
+
+
+def browser_open(url, screenshot_png=None, ready_script=None):
+    start_time = time.perf_counter()
+    # スクリーンショットが不要な静的ページはHTTPで取得する
+    if screenshot_png is None and url.startswith(("http://", "https://")):
+        result = http_open(url)
+        if result is not None:
+            elapsed = time.perf_counter() - start_time
+            logging.info(f"browser_open tier=http time={elapsed:.2f}s url={url}")
+            return result
 
-def browser_open(url, screenshot_png=None):
     content = ""
     page_source = ""
     title = ""
-    WEBDRIVER_TIMEOUT = 10
-    WEBDRIVER_ARGUMENTS = (
-        "--headless",
-        "--no-sandbox",
-        "--single-process",
-        "--disable-dev-shm-usage",
-        "--disable-gpu",
-        "--disable-extensions",
-        "--disk-cache-size=0",
-        "--aggressive-cache-discard",
-        "--disable-notifications",
-        "--disable-remote-fonts",
-        "--window-size=1366,768",
-        "--hide-scrollbars",
-        "--disable-audio-output",
-    )
     try:
-        # Selenium WebDriverの設定
-        options = webdriver.ChromeOptions()
-        service = webdriver.ChromeService("/opt/chromedriver-linux64/chromedriver")
-        options.binary_location = "/opt/chrome-linux64/chrome"
-
-        for opt in WEBDRIVER_ARGUMENTS:
-            options.add_argument(opt)
-
-        driver = webdriver.Chrome(options=options, service=service)
-        driver.set_page_load_timeout(WEBDRIVER_TIMEOUT)
-
-        # HTMLファイルを開く
-        driver.get(url)
-        time.sleep(10)  # レンダリングに時間を与える
-
-        # ページのコンテンツを取得
-        page_source = driver.page_source
-        soup = BeautifulSoup(page_source, "html.parser")
-        # scriptやstyle及びその他タグの除去
-        for s in soup(["script", "style"]):
-            s.decompose()
-        title = soup.title.string if soup.title else "タイトルなし"
-        content = soup.get_text()
-        content = re.sub(r"\n+", "\n", content)
-
-        # スクリーンショットを保存
-        if screenshot_png is not None:
-            driver.save_screenshot(screenshot_png)
-
-        # ブラウザを閉じる
-        driver.quit()
+        # プールからブラウザを取得してページを開く
+        with browser_pool.driver() as driver:
+            driver.get(url)
+            # 固定時間待つ代わりにレンダリングの完了を待つ
+            wait_until_ready(driver, ready_script)
+
+            # ページのコンテンツを取得
+            page_source = driver.page_source
+
+            # スクリーンショットを保存
+            if screenshot_png is not None:
+                driver.save_screenshot(screenshot_png)
+
+        title, content = extract_page_text(page_source)
     except Exception as e:
         logging.error(e)
 
+    elapsed = time.perf_counter() - start_time
+    logging.info(f"browser_open tier=browser time={elapsed:.2f}s url={url}")
     return title, content
@@ -1,4 +1,3 @@
-import yaml
 from blockkit import (
     Divider,
     Input,
@@ -107,10 +106,8 @@ def generate_api_key_input_message():
     return blocks
 
 
-def generate_home(assistant_name: str):
+def generate_home(assistant_name: str, config):
     blocks = []
-    with open("/function/data/assistant.yml") as f:
-        config = yaml.safe_load(f)
     current_assistant_name = config[assistant_name]["name"]
     blocks.append(Header(text="自動で入力される文脈"))
     for context in [
@@ -148,9 +145,7 @@ def generate_home(assistant_name: str):
     return payload
 
 
-def generate_select_assistant_block():
-    with open("/function/data/assistant.yml") as f:
-        config = yaml.safe_load(f)
+def generate_select_assistant_block(config):
     options = []
     for assistant_name, assistant in config.items():
         options.append(PlainOption(text=assistant["name"], value=assistant_name))
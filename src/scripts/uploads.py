@@ -0,0 +1,174 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+
+DB_MESSAGE_TABLE = os.getenv("DB_MESSAGE_TABLE")
+# アップロード済みのファイルを再利用する秒数
+UPLOAD_CACHE_TTL = int(os.getenv("UPLOAD_CACHE_TTL", str(24 * 60 * 60)))
+# 同時にアップロードするファイル数
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "4"))
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+# ファイルの内容からsha256を計算します。
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+# ファイルの内容のハッシュからOpenAIのfile_idを引き、同じファイルを再度アップロードしないクラスです。
+# キャッシュはコンテナ内のメモリとDynamoDBの2段で、file_idはAPIキーごとに管理します。
+class UploadManager:
+    def __init__(self, ttl=UPLOAD_CACHE_TTL, max_workers=UPLOAD_WORKERS, table=None):
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self.table = table
+        # (アカウント, sha256) -> (file_id, 有効期限)
+        self.cache = {}
+        # file_id -> (アカウント, sha256)
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    def _get_table(self):
+        if self.table is None and DB_MESSAGE_TABLE is not None:
+            self.table = boto3.resource("dynamodb").Table(DB_MESSAGE_TABLE)
+        return self.table
+
+    # APIキーをそのまま保存しないようにハッシュ化します。
+    def _account(self, api_key):
+        return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+    def _lookup(self, account, sha256, now):
+        with self.lock:
+            entry = self.cache.get((account, sha256))
+        if entry is not None and entry[1] > now:
+            return entry[0]
+        table = self._get_table()
+        if table is None:
+            return None
+        try:
+            item = table.get_item(Key={"doc_id": f"file_{account}_{sha256}"}).get(
+                "Item"
+            )
+        except Exception as e:
+            # DynamoDBが利用できない場合はアップロードする
+            logging.error(e)
+            return None
+        if item is None or int(item["expires_at"]) <= now:
+            return None
+        self._remember(account, sha256, item["file_id"], int(item["expires_at"]))
+        return item["file_id"]
+
+    def _remember(self, account, sha256, file_id, expires_at):
+        with self.lock:
+            self.cache[(account, sha256)] = (file_id, expires_at)
+            self.hashes[file_id] = (account, sha256)
+
+    def _store(self, account, sha256, file_id, now):
+        expires_at = now + self.ttl
+        self._remember(account, sha256, file_id, expires_at)
+        table = self._get_table()
+        if table is None:
+            return
+        try:
+            table.put_item(
+                Item={
+                    "doc_id": f"file_{account}_{sha256}",
+                    "file_id": file_id,
+                    "expires_at": expires_at,
+                }
+            )
+            # 他のコンテナからも削除できるように、file_idからハッシュを引けるようにする
+            table.put_item(
+                Item={
+                    "doc_id": f"fileid_{file_id}",
+                    "account": account,
+                    "sha256": sha256,
+                    "expires_at": expires_at,
+                }
+            )
+        except Exception as e:
+            logging.error(e)
+
+    def _upload(self, client, path):
+        with open(path, "rb") as f:
+            return client.files.create(file=f, purpose="assistants").id
+
+    # ファイルをアップロードし、filesと同じ順番でfile_idのリストを返します。
+    # アップロード済みのファイルはキャッシュのfile_idを使い、残りを並列でアップロードします。
+    def upload(self, client, api_key, files):
+        start_time = time.perf_counter()
+        now = int(time.time())
+        account = self._account(api_key)
+        hashes = [file_sha256(file) for file in files]
+        file_ids = {}
+        misses = {}
+        uploaded_bytes = 0
+        skipped_bytes = 0
+        for file, sha256 in zip(files, hashes):
+            size = os.path.getsize(file)
+            if sha256 in file_ids or sha256 in misses:
+                skipped_bytes += size
+                continue
+            file_id = self._lookup(account, sha256, now)
+            if file_id is not None:
+                file_ids[sha256] = file_id
+                skipped_bytes += size
+            else:
+                misses[sha256] = file
+                uploaded_bytes += size
+
+        if len(misses) > 0:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {
+                    sha256: executor.submit(self._upload, client, file)
+                    for sha256, file in misses.items()
+                }
+                for sha256, future in futures.items():
+                    file_ids[sha256] = future.result()
+                    self._store(account, sha256, file_ids[sha256], now)
+
+        logging.info(
+            f"upload files: uploaded={len(misses)} ({uploaded_bytes} bytes) "
+            f"skipped={len(files) - len(misses)} ({skipped_bytes} bytes) "
+            f"time={time.perf_counter() - start_time:.2f}s"
+        )
+        return [file_ids[sha256] for sha256 in hashes]
+
+    # file_idに対応する(アカウント, sha256)を取得します。見つからない場合はNoneを返します。
+    def _find_hash(self, table, file_id):
+        with self.lock:
+            key = self.hashes.pop(file_id, None)
+            if key is not None:
+                self.cache.pop(key, None)
+        if key is not None or table is None:
+            return key
+        item = table.get_item(Key={"doc_id": f"fileid_{file_id}"}).get("Item")
+        if item is None:
+            return None
+        return item["account"], item["sha256"]
+
+    # 削除したファイルや存在しないファイルをキャッシュから取り除きます。
+    # 他のコンテナでアップロードしたファイルもDynamoDBの逆引きから削除します。
+    def invalidate(self, file_ids):
+        table = self._get_table()
+        for file_id in file_ids:
+            try:
+                key = self._find_hash(table, file_id)
+                if key is None or table is None:
+                    continue
+                table.delete_item(Key={"doc_id": f"file_{key[0]}_{key[1]}"})
+                table.delete_item(Key={"doc_id": f"fileid_{file_id}"})
+            except Exception as e:
+                logging.error(e)
+
+
+# コンテナ全体で共有するアップロードのキャッシュ
+upload_manager = UploadManager()
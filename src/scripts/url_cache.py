@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+import boto3
+import requests
+from tools import browser_open
+
+# スナップショットを保存するディレクトリ
+URL_CACHE_DIR = os.getenv("URL_CACHE_DIR", "/tmp/url_cache")
+# 再検証せずにキャッシュを利用する秒数
+URL_CACHE_TTL = int(os.getenv("URL_CACHE_TTL", "3600"))
+# ディスク上のキャッシュの上限サイズ
+URL_CACHE_MAX_BYTES = int(os.getenv("URL_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+# コンテナ間で共有するS3バケット (未設定の場合は共有しない)
+URL_CACHE_BUCKET = os.getenv("URL_CACHE_BUCKET", "")
+URL_CACHE_PREFIX = "url_cache/"
+# アシスタントに渡すファイルを保存するディレクトリ (URLごとに1つのファイルを使い回す)
+URL_FILE_DIR = os.getenv("URL_FILE_DIR", "/tmp/url_files")
+REVALIDATE_TIMEOUT = 5
+
+s3_client = boto3.client("s3") if URL_CACHE_BUCKET else None
+
+# キャッシュのヒット数とミス数
+stats = {"hit": 0, "revalidated": 0, "shared_hit": 0, "miss": 0}
+_lock = threading.Lock()
+
+
+def _cache_key(url):
+    return hashlib.sha256(url.encode()).hexdigest()
+
+
+def _local_paths(key):
+    return (
+        os.path.join(URL_CACHE_DIR, f"{key}.json"),
+        os.path.join(URL_CACHE_DIR, f"{key}.txt"),
+    )
+
+
+def _read_local(key):
+    meta_file, content_file = _local_paths(key)
+    try:
+        with open(meta_file, "r") as f:
+            meta = json.load(f)
+        with open(content_file, "r") as f:
+            content = f.read()
+    except (OSError, ValueError):
+        return None
+    # 最近使われたエントリとして更新する
+    os.utime(content_file)
+    return meta, content
+
+
+def _write_local(key, meta, content):
+    os.makedirs(URL_CACHE_DIR, exist_ok=True)
+    meta_file, content_file = _local_paths(key)
+    with open(content_file, "w") as f:
+        f.write(content)
+    with open(meta_file, "w") as f:
+        json.dump(meta, f)
+    _evict()
+
+
+# 上限サイズを超えた場合は古いエントリから削除します。
+def _evict():
+    with _lock:
+        entries = []
+        total_size = 0
+        for name in os.listdir(URL_CACHE_DIR):
+            if not name.endswith(".txt"):
+                continue
+            path = os.path.join(URL_CACHE_DIR, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, name[: -len(".txt")]))
+            total_size += stat.st_size
+        entries.sort()
+        for _, size, key in entries:
+            if total_size <= URL_CACHE_MAX_BYTES:
+                break
+            for path in _local_paths(key):
+                if os.path.exists(path):
+                    os.remove(path)
+            total_size -= size
+            logging.info(f"evict url cache: {key}")
+
+
+def _read_shared(key):
+    if s3_client is None:
+        return None
+    try:
+        obj = s3_client.get_object(Bucket=URL_CACHE_BUCKET, Key=URL_CACHE_PREFIX + key)
+        meta = json.loads(obj["Metadata"]["snapshot"])
+        content = obj["Body"].read().decode("utf-8")
+    except Exception as e:
+        logging.info(f"url cache shared miss: {e}")
+        return None
+    return meta, content
+
+
+def _write_shared(key, meta, content):
+    if s3_client is None:
+        return
+    try:
+        s3_client.put_object(
+            Bucket=URL_CACHE_BUCKET,
+            Key=URL_CACHE_PREFIX + key,
+            Body=content.encode("utf-8"),
+            Metadata={"snapshot": json.dumps(meta)},
+        )
+    except Exception as e:
+        logging.error(e)
+
+
+# ETagやLast-Modifiedが変わっていないかを確認します。
+def _revalidate(url, meta):
+    headers = {}
+    if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+    if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    if len(headers) == 0:
+        return False
+    try:
+        response = requests.get(
+            url, headers=headers, timeout=REVALIDATE_TIMEOUT, stream=True
+        )
+        response.close()
+        return response.status_code == 304
+    except requests.RequestException as e:
+        logging.info(f"revalidate failed {url}: {e}")
+        return False
+
+
+# 再検証に使うヘッダーを取得します。
+def _fetch_validators(url):
+    try:
+        response = requests.head(url, timeout=REVALIDATE_TIMEOUT, allow_redirects=True)
+        return {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+    except requests.RequestException:
+        return {"etag": None, "last_modified": None}
+
+
+def _log(result, url):
+    stats[result] += 1
+    logging.info(
+        f"url cache {result}: {url} "
+        f"(hit={stats['hit'] + stats['revalidated'] + stats['shared_hit']} miss={stats['miss']})"
+    )
+
+
+# URLのページ内容を取得します。キャッシュにある場合はブラウザを起動しません。
+def get_url_content(url):
+    key = _cache_key(url)
+    now = int(time.time())
+    result = "hit"
+    entry = _read_local(key)
+    if entry is None:
+        entry = _read_shared(key)
+        result = "shared_hit"
+        if entry is not None:
+            _write_local(key, *entry)
+
+    if entry is not None:
+        meta, content = entry
+        if now - meta["fetched_at"] < URL_CACHE_TTL:
+            _log(result, url)
+            return content
+        if _revalidate(url, meta):
+            meta["fetched_at"] = now
+            _write_local(key, meta, content)
+            _write_shared(key, meta, content)
+            _log("revalidated", url)
+            return content
+
+    _log("miss", url)
+    title, content = browser_open(url)
+    if len(content) > 0:
+        meta = {"url": url, "fetched_at": now}
+        meta.update(_fetch_validators(url))
+        _write_local(key, meta, content)
+        _write_shared(key, meta, content)
+    return content
+
+
+# URLのページ内容をfilenameのファイルとして保存し、そのパスを返します。
+# メッセージごとにファイルを作らないように、URLごとに同じパスを使い回し、内容が変わった場合のみ書き換えます。
+def get_url_file(url, filename):
+    content = get_url_content(url)
+    file_dir = os.path.join(URL_FILE_DIR, _cache_key(url))
+    file_path = os.path.join(file_dir, filename)
+    try:
+        with open(file_path, "r") as f:
+            if f.read() == content:
+                return file_path
+    except OSError:
+        pass
+    os.makedirs(file_dir, exist_ok=True)
+    # 読み込み中のファイルを書きかけにしないように置き換える
+    tmp_path = f"{file_path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(content)
+    os.replace(tmp_path, file_path)
+    return file_path
@@ -13,11 +13,7 @@ def assistant_instructor(channel_id, process_ts, user_id, assistant_config, th,
     token_size = th.token_size
     files = th.files
 
-    functions = [
-        tool["function"]["name"]
-        for tool in assistant_config["tools"]
-        if tool["type"] == "function"
-    ]
+    functions = assistant_config["function_names"]
     demo_reaction = [
         {
             "message": (
@@ -0,0 +1,47 @@
+import os
+import sys
+import time
+from tempfile import mkdtemp
+
+sys.path.append("../../src/scripts")
+from browser import BrowserPool, wait_until_ready
+
+PAGES = 5
+
+
+# ローカルのHTMLファイルを生成する
+def build_pages():
+    temp_dir = mkdtemp()
+    urls = []
+    for i in range(PAGES):
+        html_file = os.path.join(temp_dir, f"page{i}.html")
+        with open(html_file, "w") as f:
+            f.write(
+                f"<html><head><title>page{i}</title></head><body><h1>page {i}</h1></body></html>"
+            )
+        urls.append("file://" + html_file)
+    return temp_dir, urls
+
+
+def render(pool, url, png_file):
+    with pool.driver() as driver:
+        driver.get(url)
+        wait_until_ready(driver)
+        driver.save_screenshot(png_file)
+
+
+def bench(name, pool, temp_dir, urls):
+    start = time.perf_counter()
+    for i, url in enumerate(urls):
+        render(pool, url, os.path.join(temp_dir, f"{name}{i}.png"))
+    elapsed = time.perf_counter() - start
+    pool.close()
+    print(f"{name:<8} {elapsed / len(urls):8.2f} s/page (total {elapsed:.2f} s)")
+    return elapsed
+
+
+if __name__ == "__main__":
+    temp_dir, urls = build_pages()
+    no_pool = bench("no-pool", BrowserPool(size=0), temp_dir, urls)
+    pool = bench("pool", BrowserPool(size=1), temp_dir, urls)
+    print(f"speedup: {no_pool / pool:.2f}x")
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+from tempfile import mkdtemp
+from pluginbase import PluginBase
+
+sys.path.append("../../src/scripts")
+import plugin
+from plugin import FilePluginRegistry, handle_file_plugin
+
+ARCHIVE_FILES = 50
+REPEAT = 5
+
+# file_pluginと同じ優先度と拡張子を持ち、ファイルを処理しないプラグイン
+PLUGINS = {
+    "zip_extract": (0, [".zip"]),
+    "pptx_extract": (0, [".pptx", ".ppt"]),
+    "pdf_extract": (1, [".pdf"]),
+    "img_to_text": (1, [".png", ".jpg", ".jpeg"]),
+    "convert_audio": (1, [".mp3", ".mp4", ".mpeg", ".mpga", ".m4a", ".wav", ".webm"]),
+}
+ARCHIVE_EXTS = [".pdf", ".png", ".txt", ".csv", ".pptx"]
+
+PLUGIN_TEMPLATE = """
+PRIORITY = {priority}
+
+
+class CreatePlugin(object):
+    def __init__(self):
+        self.target_ext = {target_ext}
+        self.description = "{name}"
+
+    def run(self, message, input_file):
+        if input_file.endswith(".zip"):
+            exts = {archive_exts}
+            return [f"/tmp/archive/{{i}}{{exts[i % len(exts)]}}" for i in range({archive_files})], message
+        return [input_file + ".txt"], message
+"""
+
+
+def write_plugins():
+    plugin_dir = mkdtemp()
+    for name, (priority, target_ext) in PLUGINS.items():
+        with open(os.path.join(plugin_dir, f"{name}.py"), "w") as f:
+            f.write(
+                PLUGIN_TEMPLATE.format(
+                    priority=priority,
+                    target_ext=target_ext,
+                    name=name,
+                    archive_exts=ARCHIVE_EXTS,
+                    archive_files=ARCHIVE_FILES,
+                )
+            )
+    return plugin_dir
+
+
+# 変更前のhandle_file_pluginのディスパッチ
+def legacy_handle_file_plugin(source, event, files):
+    message_text = event.get("text", "")
+    response_files = []
+    for file_path in files:
+        plugins_with_priority = []
+        for plugin_name in source.list_plugins():
+            plugin_module = source.load_plugin(plugin_name)
+            priority = getattr(plugin_module, "PRIORITY", float("inf"))
+            plugins_with_priority.append((priority, plugin_name))
+        plugins_with_priority.sort()
+        run_plugin = False
+        for _, plugin_name in plugins_with_priority:
+            plugin_module = source.load_plugin(plugin_name)
+            plugin_instance = plugin_module.CreatePlugin()
+            process_files = response_files + [file_path]
+            for file in process_files:
+                ext = os.path.splitext(file)[1]
+                if ext in plugin_instance.target_ext:
+                    run_plugin = True
+                    _response_files, message_text = plugin_instance.run(
+                        message_text, file
+                    )
+                    response_files.extend(_response_files)
+        if not run_plugin:
+            response_files.append(file_path)
+    return response_files
+
+
+def bench(name, func):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        response_files = func()
+    elapsed = (time.perf_counter() - start) / REPEAT
+    print(f"{name:<7} {elapsed * 1000:8.2f} ms/message  files={len(response_files)}")
+    return elapsed
+
+
+if __name__ == "__main__":
+    plugin.update_message = lambda *args, **kwargs: None
+    plugin.add_reaction = lambda *args, **kwargs: None
+    source = PluginBase(package="bench_plugins").make_plugin_source(
+        searchpath=[write_plugins()]
+    )
+    plugin.file_plugin_registry = FilePluginRegistry(source)
+    # 1つのzipと、それに続く添付ファイル
+    files = ["/tmp/upload/archive.zip", "/tmp/upload/report.pdf", "/tmp/upload/a.csv"]
+    before = bench(
+        "before", lambda: legacy_handle_file_plugin(source, {"text": ""}, files)
+    )
+    after = bench("after", lambda: handle_file_plugin({"text": ""}, files, "0")[0])
+    print(f"speedup: {before / after:.1f}x")
@@ -0,0 +1,41 @@
+import sys
+import time
+
+sys.path.append("../../src/scripts")
+import history
+from history import pack_history
+
+SIZES = [500, 1000, 2000, 4000]
+
+
+# 指定した件数のメッセージを含むスレッドを生成する
+def build_thread(size):
+    return [
+        {
+            "user": f"U{i % 7:04d}",
+            "ts": f"1700000000.{i:06d}",
+            "text": f"{i}件目のメッセージです。調査の結果を共有します。 result={i * 17}",
+        }
+        for i in range(size)
+    ]
+
+
+def bench(size):
+    messages = build_thread(size)
+    history._token_cache.clear()
+    start = time.perf_counter()
+    text, token_size, truncated_token_size = pack_history(messages)
+    cold = time.perf_counter() - start
+    # 同じスレッドへの2回目はtsごとのトークン数を再利用する
+    start = time.perf_counter()
+    pack_history(messages)
+    warm = time.perf_counter() - start
+    print(
+        f"{size:>5} messages: cold {cold * 1000:8.2f} ms ({cold / size * 1e6:6.2f} us/msg) "
+        f"warm {warm * 1000:8.2f} ms  kept={token_size} dropped={truncated_token_size}"
+    )
+
+
+if __name__ == "__main__":
+    for size in SIZES:
+        bench(size)
@@ -0,0 +1,65 @@
+import sys
+import time
+
+sys.path.append("../../src/scripts")
+import tokenizer
+from tokenizer import TokenCounter
+
+ANSWER_TOKENS = 4000
+SLACK_MAX_TOKEN_SIZE = 1500
+
+
+# 4kトークン程度の回答を生成し、トークン単位の差分に分割する
+def build_deltas():
+    unit = "回答を生成しています。```python\nprint('hello world')\n```\n"
+    text = unit
+    while tokenizer.count(text) < ANSWER_TOKENS:
+        text += unit
+    encoder = tokenizer.get_encoder()
+    deltas = []
+    buffer = b""
+    for token in encoder.encode(text):
+        buffer += encoder.decode_single_token_bytes(token)
+        try:
+            deltas.append(buffer.decode("utf-8"))
+            buffer = b""
+        except UnicodeDecodeError:
+            continue
+    return deltas
+
+
+# 従来の実装 (差分ごとにバッファ全体をエンコードする)
+def replay_legacy(deltas):
+    current_message = ""
+    for delta in deltas:
+        output_token = tokenizer.count(current_message + delta)
+        if output_token > SLACK_MAX_TOKEN_SIZE:
+            current_message = delta
+        else:
+            current_message += delta
+
+
+def replay_incremental(deltas):
+    counter = TokenCounter()
+    for delta in deltas:
+        output_token = counter.add(delta)
+        if output_token > SLACK_MAX_TOKEN_SIZE:
+            counter.reset(delta)
+
+
+def bench(name, func, deltas):
+    start = time.process_time()
+    func(deltas)
+    elapsed = time.process_time() - start
+    print(
+        f"{name:<12} {elapsed / len(deltas) * 1e6:10.2f} us/delta (total {elapsed * 1000:.2f} ms)"
+    )
+    return elapsed
+
+
+if __name__ == "__main__":
+    deltas = build_deltas()
+    print(f"deltas: {len(deltas)}")
+    legacy = bench("legacy", replay_legacy, deltas)
+    incremental = bench("incremental", replay_incremental, deltas)
+    print(f"speedup: {legacy / incremental:.2f}x")
@@ -0,0 +1,49 @@
+import sys
+import time
+import tiktoken
+
+sys.path.append("../../src/scripts")
+import tokenizer
+
+ITERATIONS = 5
+INPUT_TOKENS = 100000
+MAX_TOKENS = 12000
+
+
+# 従来の実装 (エンコーダを毎回生成し、同じテキストを3回エンコードする)
+def legacy_truncate_token_size(text, max_tokens):
+    enc = tiktoken.encoding_for_model("gpt-4")
+    origin_token_size = len(enc.encode(text, allowed_special="all"))
+    enc = tiktoken.encoding_for_model("gpt-4")
+    truncated_text = enc.decode(enc.encode(text, allowed_special="all")[:max_tokens])
+    enc = tiktoken.encoding_for_model("gpt-4")
+    token_size = len(enc.encode(truncated_text, allowed_special="all"))
+    return truncated_text, token_size, origin_token_size - token_size
+
+
+# 100kトークン程度の入力を生成する
+def build_input():
+    unit = "Slackのスレッドに投稿されたメッセージです。 The quick brown fox jumps over the lazy dog.\n"
+    text = unit
+    while tokenizer.count(text) < INPUT_TOKENS:
+        text += text
+    return tokenizer.truncate(text, INPUT_TOKENS)[0]
+
+
+def bench(name, func, text):
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        result = func(text, MAX_TOKENS)
+    elapsed = (time.perf_counter() - start) / ITERATIONS
+    print(
+        f"{name:<8} {elapsed * 1000:10.2f} ms/call  kept={result[1]} dropped={result[2]}"
+    )
+    return elapsed
+
+
+if __name__ == "__main__":
+    text = build_input()
+    print(f"input tokens: {tokenizer.count(text)}")
+    legacy = bench("legacy", legacy_truncate_token_size, text)
+    current = bench("current", tokenizer.truncate, text)
+    print(f"speedup: {legacy / current:.2f}x")
@@ -0,0 +1,118 @@
+import sys
+import itertools
+from types import SimpleNamespace
+
+sys.path.append("../../src/scripts")
+import tokenizer
+import compaction
+
+TURNS = 40
+MAX_TOKENS = 24000
+SUMMARY_TOKENS = 300
+
+
+def make_message(role, content):
+    return SimpleNamespace(
+        role=role,
+        content=[SimpleNamespace(type="text", text=SimpleNamespace(value=content))],
+        file_ids=[],
+    )
+
+
+# OpenAI Threadをメモリ上で再現するクライアント
+class ReplayClient:
+    def __init__(self):
+        self.ids = itertools.count()
+        self.threads = {}
+        self.summaries = 0
+        self.client = SimpleNamespace(
+            chat=SimpleNamespace(completions=SimpleNamespace(create=self.summarize))
+        )
+
+    def create_thread(self, messages=None):
+        thread_id = f"thread_{next(self.ids)}"
+        self.threads[thread_id] = [
+            make_message(message["role"], message["content"])
+            for message in messages or []
+        ]
+        return SimpleNamespace(id=thread_id)
+
+    def get_ai_thread_messages(self, thread_id, order="desc"):
+        messages = list(self.threads[thread_id])
+        return messages if order == "asc" else messages[::-1]
+
+    # 要約は入力を一定のトークン数に切り詰めたものとする
+    def summarize(self, model, messages):
+        self.summaries += 1
+        summary, _, _ = tokenizer.truncate(messages[-1]["content"], SUMMARY_TOKENS)
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=summary))]
+        )
+
+
+# ThreadStoreのカウンタをメモリ上で再現する
+class ReplayThreadStore:
+    def __init__(self, thread_id):
+        self.doc = {"thread_id": thread_id, "message_count": 0, "total_tokens": 0}
+
+    def get_thread_info(self):
+        return dict(self.doc)
+
+    def add(self, tokens):
+        self.doc["message_count"] += 1
+        self.doc["total_tokens"] += tokens
+
+    def replace_thread(self, doc, thread_id, message_count, total_tokens):
+        if doc["message_count"] != self.doc["message_count"]:
+            return False
+        self.doc.update(
+            thread_id=thread_id, message_count=message_count, total_tokens=total_tokens
+        )
+        return True
+
+
+def question(i):
+    return f"{i}回目の質問です。前回の結果を踏まえて次の手順を教えてください。" * 8
+
+
+def answer(i):
+    return (
+        f"{i}回目の回答です。手順は以下の通りです。設定を確認してから再実行します。"
+        * 30
+    )
+
+
+# 1ターンごとにRunへ入力されるトークン数 (スレッド全体のトークン数) を記録する
+def replay(max_tokens):
+    client = ReplayClient()
+    store = ReplayThreadStore(client.create_thread().id)
+    prompt_tokens = []
+    for i in range(TURNS):
+        thread = client.threads[store.doc["thread_id"]]
+        thread.append(make_message("user", question(i)))
+        store.add(tokenizer.count(question(i)))
+        prompt_tokens.append(
+            sum(tokenizer.count(m.content[0].text.value) for m in thread)
+        )
+        thread.append(make_message("assistant", answer(i)))
+        store.add(tokenizer.count(answer(i)))
+        doc = store.get_thread_info()
+        if compaction.needs_compaction(doc, max_tokens=max_tokens):
+            compaction.compact_thread(client, store, doc)
+    return prompt_tokens, client.summaries
+
+
+if __name__ == "__main__":
+    results = {}
+    for name, max_tokens in [("none", 0), ("compaction", MAX_TOKENS)]:
+        prompt_tokens, summaries = replay(max_tokens)
+        results[name] = prompt_tokens
+        print(
+            f"{name:<11} total={sum(prompt_tokens):>8} max/turn={max(prompt_tokens):>6} "
+            f"last={prompt_tokens[-1]:>6} summaries={summaries}"
+        )
+    for turn in range(0, TURNS, 5):
+        print(
+            f"turn {turn:>3}: none={results['none'][turn]:>6} "
+            f"compaction={results['compaction'][turn]:>6}"
+        )
@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import httpx
+from types import SimpleNamespace
+from openai import OpenAI
+
+sys.path.append("../../src/scripts")
+import ai
+
+# 1リクエストあたりの疑似的なレイテンシ (秒)
+API_LATENCY = float(os.getenv("API_LATENCY", "0.15"))
+MESSAGES = 10
+API_KEY = "sk-replay"
+ASSISTANT_ID = "asst_replay"
+THREAD_ID = "thread_replay"
+
+# 交互に切り替わるアシスタントの設定 (同じユーザが異なるアシスタントで質問する場合)
+CONFIGS = [
+    {
+        "model": "gpt-3.5-turbo-0125",
+        "instructions": "a",
+        "tools": [{"type": "retrieval"}],
+    },
+    {
+        "model": "gpt-4-turbo-preview",
+        "instructions": "b",
+        "tools": [{"type": "code_interpreter"}],
+    },
+]
+
+
+def assistant_json(body=None):
+    body = body or {}
+    return {
+        "id": ASSISTANT_ID,
+        "object": "assistant",
+        "created_at": 0,
+        "name": "replay",
+        "description": None,
+        "model": body.get("model", CONFIGS[0]["model"]),
+        "instructions": body.get("instructions", ""),
+        "tools": body.get("tools", []),
+        "file_ids": body.get("file_ids", []),
+        "metadata": {},
+    }
+
+
+def run_json(status):
+    return {
+        "id": "run_replay",
+        "object": "thread.run",
+        "thread_id": THREAD_ID,
+        "assistant_id": ASSISTANT_ID,
+        "status": status,
+        "created_at": 0,
+        "model": CONFIGS[0]["model"],
+        "instructions": "",
+        "tools": [],
+        "file_ids": [],
+        "metadata": {},
+        "usage": None,
+    }
+
+
+def sse(events):
+    body = ""
+    for event, data in events:
+        body += f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    body += "event: done\ndata: [DONE]\n\n"
+    return body
+
+
+# 記録したAPIの応答を疑似的なレイテンシ付きで返す
+def handler(request):
+    time.sleep(API_LATENCY)
+    path = request.url.path
+    if path.endswith("/runs"):
+        events = [
+            ("thread.run.created", run_json("queued")),
+            ("thread.run.completed", run_json("completed")),
+        ]
+        return httpx.Response(
+            200, text=sse(events), headers={"Content-Type": "text/event-stream"}
+        )
+    if path.startswith("/v1/assistants/"):
+        body = json.loads(request.content) if request.method == "POST" else None
+        return httpx.Response(200, json=assistant_json(body))
+    return httpx.Response(404, json={"error": {"message": path}})
+
+
+class NullCallback:
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def replay(mode):
+    ai.assistant_states.clear()
+    client = ai.AssistantAPIClient(API_KEY)
+    th = SimpleNamespace(thread_id=THREAD_ID)
+    assistant = SimpleNamespace(get_assistant_id=lambda: ASSISTANT_ID)
+    latencies = []
+    for i in range(MESSAGES):
+        config = CONFIGS[i % len(CONFIGS)]
+        start_time = time.perf_counter()
+        overrides = None
+        if mode == "override":
+            overrides = config
+        else:
+            client.update_assistant(ASSISTANT_ID, **config)
+        client.run_assistant(
+            th,
+            assistant,
+            NullCallback(),
+            NullCallback(),
+            NullCallback(),
+            "",
+            overrides=overrides,
+        )
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+if __name__ == "__main__":
+    openai_client = OpenAI(
+        api_key=API_KEY,
+        http_client=httpx.Client(transport=httpx.MockTransport(handler)),
+    )
+    ai.openai_clients.clients[API_KEY] = (openai_client, float("inf"))
+    results = {}
+    for mode in ["update", "override"]:
+        latencies = replay(mode)
+        results[mode] = sum(latencies) / len(latencies)
+        print(f"{mode:<9} {results[mode] * 1000:8.1f} ms/message")
+    print(f"saved: {(results['update'] - results['override']) * 1000:.1f} ms/message")
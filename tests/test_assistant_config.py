@@ -0,0 +1,73 @@
+import os
+import sys
+import yaml
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../src/scripts"))
+import assistant_config
+from assistant_config import AssistantConfigRegistry
+
+ASSISTANT_YAML = """
+sample_guide:
+  name: サンプルガイド
+  model: gpt-4-turbo-preview
+  instructions: |
+    あなたはサンプルの質問に回答するアシスタントです。
+  faq:
+    - text: ":face_with_monocle: 問題が未解決です"
+      value: 問題を解決するために足りない文脈があれば箇条書きで教えてください
+  tools:
+    - type: code_interpreter
+    - type: function
+      function:
+        name: simple_search
+        description: Search Google
+"""
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    assistant_file = tmp_path / "assistant.yml"
+    assistant_file.write_text(ASSISTANT_YAML)
+    parses = []
+    safe_load = yaml.safe_load
+
+    def counting_safe_load(stream):
+        parses.append(stream)
+        return safe_load(stream)
+
+    monkeypatch.setattr(assistant_config.yaml, "safe_load", counting_safe_load)
+    registry = AssistantConfigRegistry(path=str(assistant_file), data_dir=str(tmp_path))
+    registry.parses = parses
+    return registry
+
+
+def test_no_yaml_parse_after_warm_up(registry):
+    """ウォームアップ後の連続したメッセージではYAMLを読み込まないことをテストします"""
+    registry.get("sample_guide")
+    assert len(registry.parses) == 1
+    for _ in range(2):
+        config = dict(registry.get("sample_guide"))
+        assert config["function_names"] == ("simple_search",)
+        assert len(config["faq_blocks"]) == 1
+    assert len(registry.parses) == 1
+
+
+def test_reload_when_file_changed(registry):
+    """assistant.ymlが更新された場合は再読み込みすることをテストします"""
+    registry.get("sample_guide")
+    stat = os.stat(registry.path)
+    with open(registry.path, "a") as f:
+        f.write("\nother:\n  name: other\n")
+    os.utime(registry.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000))
+    assert registry.get("other")["name"] == "other"
+    assert len(registry.parses) == 2
+
+
+def test_config_is_immutable(registry):
+    """共有の設定が書き換えられないことをテストします"""
+    config = registry.get("sample_guide")
+    with pytest.raises(TypeError):
+        config["tools"] = []
+    with pytest.raises(AttributeError):
+        config["tools"].append({"type": "retrieval"})
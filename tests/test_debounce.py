@@ -0,0 +1,79 @@
+import os
+import sys
+import threading
+from botocore.exceptions import ClientError
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.append(os.path.join(os.path.dirname(__file__), "../src/scripts"))
+from debounce import MessageDebouncer, merge_events
+
+
+# MessageDebouncerが使う追加と条件付きの取り出しだけを再現するテーブル
+class FakeTable:
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames, **kwargs):
+        names = ExpressionAttributeNames
+        values = kwargs["ExpressionAttributeValues"]
+        with self.lock:
+            item = self.items.setdefault(Key["doc_id"], dict(Key))
+            if UpdateExpression.startswith("SET"):
+                item.setdefault(names["#events"], [])
+                item[names["#events"]] = item[names["#events"]] + values[":e"]
+                item[names["#latest"]] = values[":ts"]
+                item["expires_at"] = values[":exp"]
+                return {}
+            if item.get(names["#latest"]) != values[":ts"]:
+                raise ClientError(
+                    {"Error": {"Code": "ConditionalCheckFailedException"}},
+                    "UpdateItem",
+                )
+            old = dict(item)
+            item.pop(names["#events"], None)
+            item.pop(names["#latest"], None)
+            return {"Attributes": old}
+
+
+def test_merge_events():
+    """続けて送られたメッセージの本文とファイルを送信順にまとめるかテストします"""
+    events = [
+        {"ts": "2.0", "text": "2つ目", "files": [{"name": "b.pdf"}]},
+        {"ts": "1.0", "text": "1つ目"},
+        {"ts": "3.0", "text": ""},
+    ]
+    merged = merge_events(events)
+    assert merged["ts"] == "3.0"
+    assert merged["text"] == "1つ目\n2つ目"
+    assert merged["files"] == [{"name": "b.pdf"}]
+    assert merged["subtype"] == "file_share"
+
+
+def test_latest_message_takes_over():
+    """最後のメッセージの処理だけがまとめたイベントを受け取るかテストします"""
+    table = FakeTable()
+    debouncer = MessageDebouncer("thread", seconds=0, table=table)
+    first = {"user": "U1", "ts": "1.0", "text": "1つ目"}
+    second = {"user": "U1", "ts": "2.0", "text": "2つ目"}
+    other = {"user": "U2", "ts": "1.5", "text": "別のユーザ"}
+    debouncer.add(first)
+    debouncer.add(other)
+    debouncer.add(second)
+    assert debouncer.take(first) is None
+    assert debouncer.take(second) == [first, second]
+    assert debouncer.take(other) == [other]
+    assert debouncer.debounce({"user": "U1", "ts": "3.0", "text": "3つ目"}) == {
+        "user": "U1",
+        "ts": "3.0",
+        "text": "3つ目",
+        "files": [],
+    }
+
+
+def test_pending_events_are_not_stored_in_thread_info():
+    """まとめ中のメッセージをスレッド情報とは別のアイテムに保存するかテストします"""
+    table = FakeTable()
+    MessageDebouncer("thread", seconds=0, table=table).add({"user": "U1", "ts": "1.0"})
+    assert "thread" not in table.items
+    assert "pending_ts_U1" in table.items["debounce_thread"]
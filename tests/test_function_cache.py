@@ -0,0 +1,32 @@
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.append(os.path.join(os.path.dirname(__file__), "../src/scripts"))
+from function_cache import FunctionResultCache, plugin_cache_ttl, FUNCTION_CACHE_TTL
+
+
+def test_arguments_are_normalized(tmp_path):
+    """引数のキーの順番や空白が違っても同じ結果を返すかテストします"""
+    cache = FunctionResultCache(cache_dir=str(tmp_path))
+    assert cache.get("simple_search", '{"query": "slack", "limit": 3}') is None
+    cache.set("simple_search", '{"query": "slack", "limit": 3}', "result", ttl=60)
+    assert cache.get("simple_search", '{"limit":3,"query":"slack"}') == "result"
+    assert cache.get("notion_search", '{"limit":3,"query":"slack"}') is None
+
+
+def test_disk_tier_and_expiry(tmp_path):
+    """別のインスタンスからディスクの結果を読み込み、期限切れの結果は返さないかテストします"""
+    cache = FunctionResultCache(cache_dir=str(tmp_path))
+    cache.set("simple_search", "{}", "result", ttl=60)
+    cache.set("slack_search", "{}", "expired", ttl=-1)
+    other = FunctionResultCache(cache_dir=str(tmp_path))
+    assert other.get("simple_search", "{}") == "result"
+    assert other.stats["disk_hit"] == 1
+    assert other.get("slack_search", "{}") is None
+
+
+def test_plugin_cache_ttl():
+    """プラグインモジュールのCACHE_TTLでキャッシュの期間を変更できるかテストします"""
+    assert plugin_cache_ttl(SimpleNamespace()) == FUNCTION_CACHE_TTL
+    assert plugin_cache_ttl(SimpleNamespace(CACHE_TTL=0)) == 0
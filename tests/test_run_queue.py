@@ -0,0 +1,136 @@
+import os
+import sys
+import time
+import threading
+import pytest
+from botocore.exceptions import ClientError
+
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+sys.path.append(os.path.join(os.path.dirname(__file__), "../src/scripts"))
+from run_queue import (
+    ThreadRunQueue,
+    RunQueueTimeoutError,
+    queue_timeout,
+    RUN_QUEUE_TIMEOUT,
+    RUN_QUEUE_RESERVED_TIME,
+)
+
+
+# ThreadRunQueueが使う条件付き書き込みだけを再現するテーブル
+class FakeTable:
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def get_item(self, Key, ConsistentRead=False):
+        with self.lock:
+            item = self.items.get(Key["doc_id"])
+            return {} if item is None else {"Item": dict(item)}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeValues, **kwargs):
+        values = ExpressionAttributeValues
+        with self.lock:
+            self.writes += 1
+            item = self.items.setdefault(Key["doc_id"], {})
+            if UpdateExpression.startswith("ADD waiting"):
+                item["waiting"] = item.get("waiting", 0) + values[":c"]
+                return {"Attributes": {"waiting": item["waiting"]}}
+            if UpdateExpression.startswith("SET"):
+                if "owner" in item and item["expires_at"] >= values[":now"]:
+                    raise self._conditional_error()
+                item.update(owner=values[":o"], expires_at=values[":e"])
+                return {}
+            if item.get("owner") != values[":o"]:
+                raise self._conditional_error()
+            del item["owner"]
+            item["expires_at"] = values[":e"]
+            return {}
+
+    def _conditional_error(self):
+        return ClientError(
+            {"Error": {"Code": "ConditionalCheckFailedException"}}, "UpdateItem"
+        )
+
+
+def test_concurrent_messages_are_answered_in_turn():
+    """同じスレッドに同時に送られた3件のメッセージが順番に全て回答されるかテストします"""
+    table = FakeTable()
+    answered = []
+    depths = []
+    active = []
+    errors = []
+
+    def handle_message(text):
+        run_queue = ThreadRunQueue("thread", poll_interval=0.01, table=table)
+        try:
+            run_queue.acquire(on_wait=depths.append)
+            # 同じスレッドでRunが同時に実行されていないこと
+            if len(active) > 0:
+                errors.append(f"{text} started while {active[0]} is running")
+            active.append(text)
+            time.sleep(0.05)
+            active.remove(text)
+            answered.append(text)
+        finally:
+            run_queue.release()
+
+    workers = [
+        threading.Thread(target=handle_message, args=(f"question{i}",))
+        for i in range(3)
+    ]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert errors == []
+    assert sorted(answered) == ["question0", "question1", "question2"]
+    # 2件は実行中のRunを待つ
+    assert len(depths) == 2
+    assert table.items["lease_thread"]["waiting"] == 0
+    assert "owner" not in table.items["lease_thread"]
+
+
+def test_expired_lease_is_taken_over():
+    """有効期限が切れた実行権は次のメッセージが取得できるかテストします"""
+    table = FakeTable()
+    ThreadRunQueue("thread", ttl=-1, table=table).acquire()
+    run_queue = ThreadRunQueue("thread", poll_interval=0.01, timeout=1, table=table)
+    run_queue.acquire()
+    assert table.items["lease_thread"]["owner"] == run_queue.owner
+
+
+def test_wait_timeout():
+    """実行中のRunが終わらない場合はタイムアウトするかテストします"""
+    table = FakeTable()
+    ThreadRunQueue("thread", table=table).acquire()
+    run_queue = ThreadRunQueue("thread", poll_interval=0.01, timeout=0.05, table=table)
+    with pytest.raises(RunQueueTimeoutError):
+        run_queue.acquire()
+    assert table.items["lease_thread"]["waiting"] == 0
+
+
+def test_queue_timeout_leaves_time_for_run():
+    """Lambdaの残り時間からRunの実行時間を残して待機時間を決めるかテストします"""
+    assert queue_timeout() == RUN_QUEUE_TIMEOUT
+    assert queue_timeout(time.time() + 1000) == RUN_QUEUE_TIMEOUT
+    timeout = queue_timeout(time.time() + RUN_QUEUE_RESERVED_TIME + 30)
+    assert 29 <= timeout <= 30
+    assert queue_timeout(time.time() + 10) == 0
+
+
+def test_waiting_does_not_write_until_released():
+    """待機中は読み込みで確認し、解放されるまで条件付き書き込みを行わないかテストします"""
+    table = FakeTable()
+    owner = ThreadRunQueue("thread", table=table)
+    owner.acquire()
+    run_queue = ThreadRunQueue("thread", poll_interval=0.01, timeout=0.2, table=table)
+    with pytest.raises(RunQueueTimeoutError):
+        run_queue.acquire()
+    # 取得の書き込み、最初の取得の試行、待機数の増減のみ
+    assert table.writes == 4
+    run_queue.release()
+    owner.release()
+    owner.release()
+    assert table.writes == 5